@@ -0,0 +1,176 @@
+import collections
+import configparser
+import heapq
+import json
+import os
+import time
+from build_patch import *
+from ds6_util import *
+
+
+def build_text_dictionary(text_runs, code_values, max_entry_length=8):
+    # Every string of 2 to max_entry_length characters is counted once up front. Then the entry
+    # that saves the most is taken, and only the runs it appeared in are counted again, after
+    # being cut up wherever the entry was used. Cutting the runs means later entries never
+    # overlap earlier ones, and it means counts only ever go down, so stale scores in the heap
+    # can simply be put back with their new value when they come up.
+    runs = {}
+    gram_counts = collections.Counter()
+    gram_runs = collections.defaultdict(set)
+
+    def index_run(run_id, run_text, count_change):
+        for gram_length in range(2, max_entry_length + 1):
+            for offset in range(len(run_text) - gram_length + 1):
+                gram = run_text[offset:offset + gram_length]
+                gram_counts[gram] += count_change
+                if count_change > 0:
+                    gram_runs[gram].add(run_id)
+
+    def get_saving(gram):
+        # Each use saves all but one byte, but the entry itself has to be stored with its terminator.
+        return gram_counts[gram] * (len(gram) - 1) - (len(gram) + 1)
+
+    for run_text in text_runs:
+        if len(run_text) >= 2:
+            runs[len(runs)] = run_text
+            index_run(len(runs) - 1, run_text, 1)
+    next_run_id = len(runs)
+
+    heap = [(-get_saving(gram), gram) for gram in gram_counts if get_saving(gram) > 0]
+    heapq.heapify(heap)
+
+    dictionary = {}
+
+    while len(heap) > 0 and len(dictionary) < len(code_values):
+        negative_saving, gram = heapq.heappop(heap)
+        saving = get_saving(gram)
+        if saving <= 0:
+            continue
+        if saving != -negative_saving:
+            heapq.heappush(heap, (-saving, gram))
+            continue
+
+        dictionary[gram.decode('ascii')] = code_values[len(dictionary)]
+
+        for run_id in sorted(gram_runs.pop(gram)):
+            if run_id not in runs:
+                continue
+
+            run_text = runs.pop(run_id)
+            index_run(run_id, run_text, -1)
+
+            for piece in run_text.split(gram):
+                if len(piece) >= 2:
+                    runs[next_run_id] = piece
+                    index_run(next_run_id, piece, 1)
+                    next_run_id += 1
+
+    return dictionary
+
+
+def load_sector_texts(csv_base_path="csv"):
+    sector_texts = {}
+
+    for sector_type in ["Scenarios", "Combats"]:
+        sector_path = os.path.join(csv_base_path, sector_type)
+        for file_name in sorted(os.listdir(sector_path)):
+            if not file_name.endswith(".csv"):
+                continue
+
+            trans = load_translations_csv(os.path.join(sector_path, file_name))
+            texts = {}
+            for key, trans_info in trans.items():
+                event_addr = int(key, base=16)
+                if 'translation' in trans_info:
+                    texts.update(split_translation(event_addr, trans_info['translation']))
+                else:
+                    texts[event_addr] = trans_info['original']
+
+            sector_texts[f"{sector_type}/{file_name[:-4]}"] = texts
+
+    return sector_texts
+
+
+def encode_sector_texts(texts):
+    encoded_translations = {}
+    for event_addr, text in texts.items():
+        encoded, references, locators = encode_event(text)
+        encoded_translations[event_addr] = { 'encoded': encoded, 'references': references, 'locators': locators }
+    return encoded_translations
+
+
+def get_dictionary_saving(run_text, dictionary, max_entry_length=8):
+    # Takes the longest entry that matches at each point in a run of text, and counts the bytes that
+    # would save. Runs never start right after a condition, which only covers a single byte.
+    run_text = run_text.decode('ascii')
+    saving = 0
+
+    offset = 0
+    while offset < len(run_text):
+        for entry_length in range(min(max_entry_length, len(run_text) - offset), 1, -1):
+            if run_text[offset:offset + entry_length] in dictionary:
+                saving += entry_length - 1
+                offset += entry_length
+                break
+        else:
+            offset += 1
+
+    return saving
+
+
+if __name__ == '__main__':
+    # This is only an analysis of how much a dictionary could save. The game can't decode dictionary
+    # codes, so nothing in the build uses the dictionary this saves.
+    configfile = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    configfile.read("ds6_patch.conf")
+    config = configfile['DEFAULT']
+
+    print("Reading translations...")
+    sector_texts = load_sector_texts()
+    encoded_sectors = { sector_name: encode_sector_texts(texts) for sector_name, texts in sector_texts.items() }
+
+    # Half-width katakana are a single byte each, so any that aren't used anywhere already are free
+    # to stand for dictionary entries.
+    used_values = set()
+    text_runs = []
+    sector_text_runs = {}
+    for sector_name, encoded_translations in encoded_sectors.items():
+        for translation_info in encoded_translations.values():
+            for offset, code in get_encoded_instructions(translation_info['encoded']) or []:
+                if code is None:
+                    used_values.add(translation_info['encoded'][offset])
+        sector_text_runs[sector_name] = [run_text for _, _, run_text in get_text_runs(encoded_translations, encoded_translations.keys())]
+        text_runs += sector_text_runs[sector_name]
+
+    code_values = [value for value in range(0xa1, 0xe0) if value not in used_values]
+    print(f"{len(code_values)} byte values are free for dictionary entries")
+
+    start_time = time.perf_counter()
+    dictionary = build_text_dictionary(text_runs, code_values)
+    print(f"Built a dictionary of {len(dictionary)} entries from {len(text_runs)} runs of text in {time.perf_counter() - start_time:.2f} seconds")
+    print()
+
+    for entry, value in dictionary.items():
+        print(f"  {value:02x} {json.dumps(entry)}")
+    print()
+
+    sector_savings = []
+    total_before = 0
+    total_after = 0
+    for sector_name in sector_texts:
+        before = sum([len(translation_info['encoded']) for translation_info in encoded_sectors[sector_name].values()])
+        after = before - sum([get_dictionary_saving(run_text, dictionary) for run_text in sector_text_runs[sector_name]])
+        sector_savings.append((before - after, before, sector_name))
+        total_before += before
+        total_after += after
+
+    print(f"Encoded text: {total_before} -> {total_after} bytes ({100 * (total_before - total_after) / total_before:.1f}% smaller)")
+    print("Biggest savings:")
+    for saving, before, sector_name in sorted(sector_savings, reverse=True)[:10]:
+        print(f"  {sector_name}: {saving}/{before} bytes ({100 * saving / before:.1f}%)")
+
+    os.makedirs(os.path.dirname(config['OutputTextDictionary']), exist_ok=True)
+    with open(config['OutputTextDictionary'], 'w+', encoding='utf8') as out_file:
+        json.dump({ 'entries': { entry: value for entry, value in dictionary.items() } }, out_file, indent=2)
+    print()
+    print(config['OutputTextDictionary'])
@@ -0,0 +1,188 @@
+import io
+import json
+import numpy as np
+import os
+import sys
+import time
+from ds6_gfx_util import *
+
+
+# The encoded sizes are the same on every machine, so their baseline is checked in. Timings only
+# mean anything on the machine they came from, so they're kept next to the script but not checked in.
+SIZE_BASELINE_FILE_NAME = "benchmark_gfx.json"
+TIME_BASELINE_FILE_NAME = "benchmark_gfx_times.json"
+
+# Timings are noisy, so they only count as a regression if they're well past the baseline, by both
+# a ratio and an absolute amount. Sizes are exact, so any growth at all is a regression.
+TIME_TOLERANCE = 2.0
+MIN_TIME_DIFFERENCE = 0.005
+
+REPEAT_COUNT = 5
+
+
+def make_noise_pixels(rng, width, height, density):
+    return np.where(rng.random((height, width, 3)) < density, 220, 0).astype(np.uint8)
+
+
+def make_gradient_pixels(width, height):
+    # Ordered dithering of a gradient that runs a different way in each channel, which is what
+    # shading tends to look like at this color depth.
+    bayer = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) / 16
+    thresholds = np.tile(bayer, (height // 4 + 1, width // 4 + 1))[:height, :width]
+
+    ys, xs = np.mgrid[0:height, 0:width]
+    levels = [xs / width, ys / height, (xs + ys) / (width + height)]
+
+    return np.stack([np.where(level > thresholds, 220, 0) for level in levels], axis=2).astype(np.uint8)
+
+
+def make_text_pixels(rng, width, height):
+    # Lines of glyph-sized cells drawn from a small set of random glyphs, on a plain background with
+    # a window border, like a message box.
+    glyphs = [rng.random((16, 8)) < 0.3 for _ in range(40)]
+
+    lit = np.zeros((height, width), dtype=bool)
+    lit[2:4, :] = lit[-4:-2, :] = lit[:, 2:4] = lit[:, -4:-2] = True
+
+    for line_y in range(8, height - 24, 20):
+        for cell_x in range(8, width - 16, 8):
+            if rng.random() < 0.85:
+                lit[line_y:line_y + 16, cell_x:cell_x + 8] = glyphs[rng.integers(len(glyphs))]
+
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    pixels[lit] = [220, 220, 220]
+    pixels[~lit] = [0, 0, 220]
+    return pixels
+
+
+def load_corpus():
+    corpus = {}
+
+    for dir_path, _, file_names in sorted(os.walk("gfx")):
+        for file_name in sorted(file_names):
+            if file_name.endswith(".png"):
+                file_path = os.path.join(dir_path, file_name)
+                corpus[file_path.replace(os.sep, "/")] = load_bitplanes_from_image_file(file_path)
+
+    # The synthetic images are seeded, so they're the same from run to run.
+    rng = np.random.default_rng(0x98)
+    corpus["synthetic/noise_sparse"] = load_bitplanes_from_pixels(make_noise_pixels(rng, 640, 200, 0.05))
+    corpus["synthetic/noise_dense"] = load_bitplanes_from_pixels(make_noise_pixels(rng, 640, 200, 0.5))
+    corpus["synthetic/gradient"] = load_bitplanes_from_pixels(make_gradient_pixels(640, 200))
+    corpus["synthetic/text"] = load_bitplanes_from_pixels(make_text_pixels(rng, 640, 200))
+
+    return corpus
+
+
+def time_best_of(func):
+    best_time = None
+    for _ in range(REPEAT_COUNT):
+        start_time = time.perf_counter()
+        result = func()
+        elapsed_time = time.perf_counter() - start_time
+        best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+    return best_time, result
+
+
+def benchmark_image(planes):
+    raw_size = len(planes[0]) * len(planes[0][0]) * 3
+
+    encode_time, encoded = time_best_of(lambda: encode_bitplanes(planes, (0, 0), 0))
+    decode_time, (_, _, decoded_planes) = time_best_of(lambda: decode_bitplanes(io.BytesIO(bytes(encoded))))
+
+    if decoded_planes != planes:
+        raise Exception("Image did not survive being encoded and decoded!")
+
+    # The greedy encoder is what was used before the optimal one, and is only here to compare against.
+    greedy_size = len(encode_bitplanes(planes, (0, 0), 0, optimal=False))
+
+    return {
+        'raw_size': raw_size,
+        'encoded_size': len(encoded),
+        'greedy_size': greedy_size,
+        'encode_time': encode_time,
+        'decode_time': decode_time,
+        'encode_throughput': raw_size / encode_time,
+        'decode_throughput': raw_size / decode_time
+    }
+
+
+def find_size_regressions(results, size_baseline):
+    regressions = []
+
+    for name, result in results.items():
+        if name in size_baseline and result['encoded_size'] > size_baseline[name]:
+            regressions.append(f"{name}: encoded to {result['encoded_size']} bytes, up from {size_baseline[name]}")
+        if result['encoded_size'] > result['greedy_size']:
+            regressions.append(f"{name}: encoded to {result['encoded_size']} bytes, more than the greedy encoder's {result['greedy_size']}")
+
+    return regressions
+
+
+def find_time_regressions(results, time_baseline):
+    regressions = []
+
+    for name, result in results.items():
+        if name not in time_baseline:
+            continue
+        baseline_result = time_baseline[name]
+
+        for time_key in ['encode_time', 'decode_time']:
+            if result[time_key] > baseline_result[time_key] * TIME_TOLERANCE and result[time_key] - baseline_result[time_key] > MIN_TIME_DIFFERENCE:
+                regressions.append(f"{name}: {time_key} of {result[time_key] * 1000:.1f} ms, up from {baseline_result[time_key] * 1000:.1f} ms")
+
+    return regressions
+
+
+def load_baseline(file_name):
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'r', encoding='utf8') as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(file_name, baseline):
+    with open(file_name, 'w+', encoding='utf8') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+        baseline_file.write("\n")
+    print(f"Saved baseline to {file_name}")
+
+
+if __name__ == '__main__':
+    # Pass --update-baseline to save this run's results as the new baseline.
+    update_baseline = "--update-baseline" in sys.argv[1:]
+
+    corpus = load_corpus()
+
+    results = {}
+    for name, planes in corpus.items():
+        results[name] = benchmark_image(planes)
+
+        result = results[name]
+        print(f"{name}: {result['raw_size']} -> {result['encoded_size']} bytes ({100 * result['encoded_size'] / result['raw_size']:.1f}%, "
+              f"{result['greedy_size'] - result['encoded_size']} bytes saved over the greedy encoder), "
+              f"encode {result['encode_time'] * 1000:.1f} ms ({result['encode_throughput'] / 1024:.0f} KB/s), "
+              f"decode {result['decode_time'] * 1000:.1f} ms ({result['decode_throughput'] / 1024:.0f} KB/s)")
+    print()
+
+    regressions = []
+
+    size_baseline = None if update_baseline else load_baseline(SIZE_BASELINE_FILE_NAME)
+    if size_baseline is None:
+        save_baseline(SIZE_BASELINE_FILE_NAME, { name: result['encoded_size'] for name, result in results.items() })
+    else:
+        regressions += find_size_regressions(results, size_baseline)
+
+    time_baseline = None if update_baseline else load_baseline(TIME_BASELINE_FILE_NAME)
+    if time_baseline is None:
+        save_baseline(TIME_BASELINE_FILE_NAME, { name: { 'encode_time': result['encode_time'], 'decode_time': result['decode_time'] } for name, result in results.items() })
+    else:
+        regressions += find_time_regressions(results, time_baseline)
+
+    if len(regressions) > 0:
+        print("Regressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+    print("No regressions against the baseline.")
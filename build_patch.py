@@ -1,80 +1,165 @@
-﻿import configparser
-import ips_util
+﻿import bisect
+import configparser
+import contextlib
+import heapq
+import io
+import json
 import os
+import shutil
+import tracemalloc
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from ds6_build_util import *
 from ds6_gfx_util import *
 from ds6_util import *
-from tempfile import NamedTemporaryFile
+
+
+# Each process has a profiler of its own. The worker processes hand their records back through build_writes.
+build_profiler = BuildProfiler()
 
 
 class SpacePool:
+    # Spans are kept sorted by start address, with a second list sorted by size for the best and
+    # worst fit strategies. First fit uses a sparse max tree over the address space, so none of
+    # the strategies need to look at every span.
+    ADDRESS_BITS = 32
+
     def __init__(self):
-        self._available_spans = []
+        self._span_starts = []
+        self._span_ends = {}
+        self._spans_by_size = []
+        self._largest_by_node = {}
+        self._total_available_space = 0
 
     @property
     def total_available_space(self):
-        return sum([s['end'] - s['start'] + 1 for s in self._available_spans])
+        return self._total_available_space
 
     @property
     def largest_available_space(self):
-        return max([s['end'] - s['start'] + 1 for s in self._available_spans])
+        return self._spans_by_size[-1][0] if len(self._spans_by_size) > 0 else 0
+
+    @property
+    def spans(self):
+        return [(start, self._span_ends[start]) for start in self._span_starts]
+
+    def _update_largest(self, start, size):
+        if size > 0:
+            self._largest_by_node[(0, start)] = size
+        else:
+            self._largest_by_node.pop((0, start), None)
+
+        for level in range(1, SpacePool.ADDRESS_BITS + 1):
+            node = start >> level
+            largest = max(self._largest_by_node.get((level - 1, node * 2), 0), self._largest_by_node.get((level - 1, node * 2 + 1), 0))
+            if largest > 0:
+                self._largest_by_node[(level, node)] = largest
+            else:
+                self._largest_by_node.pop((level, node), None)
+
+    def _find_first_fit(self, length):
+        # Every span has at least one byte, so an empty request just takes the first span.
+        length = max(length, 1)
+        if len(self._span_starts) == 0 or self._largest_by_node.get((SpacePool.ADDRESS_BITS, 0), 0) < length:
+            return None
+
+        # Walk down from the root, going left whenever the left subtree has a span that's big enough.
+        node = 0
+        for level in range(SpacePool.ADDRESS_BITS - 1, -1, -1):
+            node *= 2
+            if self._largest_by_node.get((level, node), 0) < length:
+                node += 1
+        return node
+
+    def _insert_span(self, start, end):
+        size = end - start + 1
+        bisect.insort(self._span_starts, start)
+        self._span_ends[start] = end
+        bisect.insort(self._spans_by_size, (size, start))
+        self._update_largest(start, size)
+        self._total_available_space += size
+
+    def _remove_span(self, start):
+        end = self._span_ends.pop(start)
+        size = end - start + 1
+        del self._span_starts[bisect.bisect_left(self._span_starts, start)]
+        del self._spans_by_size[bisect.bisect_left(self._spans_by_size, (size, start))]
+        self._update_largest(start, 0)
+        self._total_available_space -= size
+        return end
 
     def add_space(self, start, end):
         if end < start:
             raise Exception("Start must come before end!")
 
-        should_append = True
-        for span_index, span in enumerate(self._available_spans):
-            if end < span['start']:
-                self._available_spans.insert(span_index, { 'start': start, 'end': end} )
-                should_append = False
-                break
-            elif start >= span['start'] and start <= span['end']:
-                print(f"    Space from {start:04x} to {end:04x} overlaps with existing space from {span['start']:04x} to {span['end']:04x}")
-                span['end'] = max(span['end'], end)
-                should_append = False
-                break
-            elif start == span['end'] + 1:
-                span['end'] = end
-                should_append = False
-                break
-
-        if should_append:
-            self._available_spans.append( { 'start': start, 'end': end } )
+        merged_start = start
+        merged_end = end
+
+        # Merge with the span before this one if it overlaps or touches it...
+        span_index = bisect.bisect_right(self._span_starts, start)
+        if span_index > 0:
+            prev_start = self._span_starts[span_index - 1]
+            prev_end = self._span_ends[prev_start]
+            if start <= prev_end:
+                print(f"    Space from {start:04x} to {end:04x} overlaps with existing space from {prev_start:04x} to {prev_end:04x}")
+            if start <= prev_end + 1:
+                self._remove_span(prev_start)
+                merged_start = prev_start
+                merged_end = max(merged_end, prev_end)
+                span_index -= 1
+
+        # ...and with any spans after it.
+        while span_index < len(self._span_starts) and self._span_starts[span_index] <= merged_end + 1:
+            next_start = self._span_starts[span_index]
+            if next_start <= end:
+                print(f"    Space from {start:04x} to {end:04x} overlaps with existing space from {next_start:04x} to {self._span_ends[next_start]:04x}")
+            merged_end = max(merged_end, self._remove_span(next_start))
+
+        self._insert_span(merged_start, merged_end)
 
     def take_space(self, length, strategy='first'):
         addr = None
 
-        best_index = None
-        best_rating = None
-
-        for span_index, span in enumerate(self._available_spans):
-            if span['end'] - span['start'] + 1 >= length:
-                if strategy == 'smallest':
-                    span_rating = -(span['end'] - span['start'] + 1 - length)
-                elif strategy == 'largest':
-                    span_rating = span['end'] - span['start'] + 1 - length
-                else:
-                    span_rating = -span_index # First
-
-                if best_rating is None or span_rating > best_rating:
-                    best_rating = span_rating
-                    best_index = span_index
-
-        if best_index is not None:
-            span = self._available_spans[best_index]
-            addr = span['start']
-            span['start'] += length
-            if span['start'] > span['end']:
-                del self._available_spans[best_index]
+        if strategy == 'smallest':
+            size_index = bisect.bisect_left(self._spans_by_size, (length, -1))
+            if size_index < len(self._spans_by_size):
+                addr = self._spans_by_size[size_index][1]
+        elif strategy == 'largest':
+            # Ties go to the lowest address, same as the other strategies.
+            if self.largest_available_space >= length and len(self._spans_by_size) > 0:
+                addr = self._spans_by_size[bisect.bisect_left(self._spans_by_size, (self.largest_available_space, -1))][1]
         else:
+            addr = self._find_first_fit(length)
+
+        if addr is None:
             raise Exception(f"Unable to find {length} bytes of space! Total available: {self.total_available_space} bytes; largest available: {self.largest_available_space} bytes")
 
+        end = self._remove_span(addr)
+        if addr + length <= end:
+            self._insert_span(addr + length, end)
+
+        return addr
+
+    def take_space_at(self, addr, length):
+        if length <= 0:
+            return addr
+
+        span_index = bisect.bisect_right(self._span_starts, addr) - 1
+        if span_index < 0 or self._span_ends[self._span_starts[span_index]] < addr + length - 1:
+            raise Exception(f"Space from {addr:04x} to {addr + length - 1:04x} is not available!")
+
+        start = self._span_starts[span_index]
+        end = self._remove_span(start)
+        if start < addr:
+            self._insert_span(start, addr - 1)
+        if addr + length <= end:
+            self._insert_span(addr + length, end)
+
         return addr
 
     def dump(self):
         print("Available space:")
-        for span in self._available_spans:
-            print(f"  {span['start']:04x}~{span['end']:04x} ({span['end'] - span['start'] + 1} bytes)")
+        for start, end in self.spans:
+            print(f"  {start:04x}~{end:04x} ({end - start + 1} bytes)")
         print()
 
 
@@ -88,7 +173,7 @@ def patch_data_table(patch, file_name, disk_addr, max_length, entry_stride):
                 raise Exception(f"Translation at index {index} of Data/Items is too long! original={text_info['original']}, translation={text_info['translation']} ({len(encoded)} bytes)")
             elif len(encoded) < max_length:
                 encoded = encoded.rjust(max_length, b' ')
-            patch.add_record(disk_addr + index*entry_stride, encoded)
+            patch.add_record(disk_addr + index*entry_stride, encoded, origin=f"{file_name} entry {index}")
 
 
 def patch_menu(patch, base_addr, items, max_length, references):
@@ -101,44 +186,31 @@ def patch_menu(patch, base_addr, items, max_length, references):
 
     if len(patch_data) > max_length:
         raise Exception(f"Not enough space to patch menu at {base_addr:04x}! available={max_length} bytes; used={len(patch_data)} bytes")
+    build_profiler.record_budget(f"menu at {base_addr:04x}", len(patch_data), max_length)
 
-    patch.add_record(base_addr - 0x4000 + 0x13e10 + 4, patch_data.ljust(max_length - 4, b'\x00'))
+    patch.add_record(base_addr - 0x4000 + 0x13e10 + 4, patch_data.ljust(max_length - 4, b'\x00'), origin=f"menu at {base_addr:04x}")
 
     for offset, ref_addr in zip(offsets, references):
         if ref_addr is not None:
-            patch.add_record(ref_addr - 0x4000 + 0x13e10, int.to_bytes(base_addr + offset + 1, length=2, byteorder='little'))
+            patch.add_record(ref_addr - 0x4000 + 0x13e10, int.to_bytes(base_addr + offset + 1, length=2, byteorder='little'), origin=f"menu at {base_addr:04x} reference at {ref_addr:04x}", kind='reference')
 
 
-def patch_asm(patch, nasm_path, base_addr, max_length, asm_code):
+def patch_asm(patch, assembler, base_addr, max_length, asm_code):
     if isinstance(asm_code, str):
-        with NamedTemporaryFile(mode="w+", delete=False) as src_file, NamedTemporaryFile(mode="rb", delete=False) as dest_file:
-            src_file_name = src_file.name
-            dest_file_name = dest_file.name
-
-            src_file.write("BITS 16\n")
-            src_file.write(f"org 0x{base_addr:04x}\n\n")
-            src_file.write(asm_code)
-
-        if not os.path.exists(nasm_path):
-            raise Exception(f"NASM is not available at the path {nasm_path}!")
-
-        os.system(f"\"{nasm_path}\" {src_file.name} -o {dest_file_name}")
-
-        with open(dest_file_name, "rb") as dest_file:
-            encoded = dest_file.read()
-
-        os.remove(src_file_name)
-        os.remove(dest_file_name)
-
+        # The record is added once the whole batch has been assembled.
+        assembler.add(base_addr, asm_code, lambda encoded: write_asm_patch(patch, base_addr, max_length, encoded))
     else:
-        encoded = asm_code
+        write_asm_patch(patch, base_addr, max_length, asm_code)
+
 
+def write_asm_patch(patch, base_addr, max_length, encoded):
     print(f"Encoding asm patch at {base_addr:04x} ({len(encoded)}/{max_length} bytes)")
 
     if len(encoded) > max_length:
         raise Exception(f"Not enough space to patch asm code at {base_addr}! available={max_length} bytes; used={len(encoded)} bytes")
+    build_profiler.record_budget(f"asm at {base_addr:04x}", len(encoded), max_length)
 
-    patch.add_record(base_addr - 0x4000 + 0x13e10, encoded.ljust(max_length, b'\x90'))
+    patch.add_record(base_addr - 0x4000 + 0x13e10, encoded.ljust(max_length, b'\x90'), origin=f"asm at {base_addr:04x}", kind='code')
 
 
 def encode_translations(event_list, translated_text):
@@ -152,19 +224,7 @@ def encode_translations(event_list, translated_text):
         if context in translated_text and 'translation' in translated_text[context]:
             translation = translated_text[context]['translation']
 
-            splits = translation.split("<SPLIT")
-            split_addrs = []
-
-            for split_index in range(len(splits)):
-                if split_index == 0:
-                    split_addrs.append(event_addr)
-                else:
-                    split_addrs.append(int(splits[split_index][:4], base=16))
-                    splits[split_index] = splits[split_index][5:]
-                    splits[split_index - 1] += f"<JUMP{split_addrs[split_index]:04x}>"
-
-            last_addr = None
-            for split, split_addr in zip(splits, split_addrs):
+            for split_addr, split in split_translation(event_addr, translation):
                 translation_encoded, translation_references, translation_locators = encode_event(split)
                 encoded_translations[split_addr] = { 'encoded': translation_encoded, 'references': translation_references, 'locators': translation_locators, 'orig_event_addr': event_addr }
         else:
@@ -173,10 +233,490 @@ def encode_translations(event_list, translated_text):
     return encoded_translations
 
 
-def relocate_events(event_list, encoded_translations, empty_space=None, packing_strategy='first'):
+def pack_spans(item_sizes, spans, node_limit=1000):
+    # Sort biggest first, which is what both the greedy passes and the search want. Ties are broken
+    # by key so the layout doesn't depend on dict order.
+    items = sorted(item_sizes.items(), key=lambda item: (-item[1], item[0]))
 
-    relocations = {}
+    for strategy in ['first', 'smallest']:
+        space_pool = SpacePool()
+        for start, end in spans:
+            space_pool.add_space(start, end)
+
+        placements = {}
+        for item_key, item_size in items:
+            if item_size > space_pool.largest_available_space:
+                placements = None
+                break
+            placements[item_key] = space_pool.take_space(item_size, strategy)
+
+        if placements is not None:
+            return placements, f"{strategy} fit decreasing"
+
+    # The greedy passes didn't fit, so fall back on a bounded search over which span each item goes into.
+    capacities = [end - start + 1 for start, end in spans]
+    assignments = [None] * len(items)
+    remaining_sizes = [sum(item_size for _, item_size in items[item_index:]) for item_index in range(len(items) + 1)]
+    node_count = 0
+
+    def search(item_index):
+        nonlocal node_count
+
+        if item_index == len(items):
+            return True
+
+        node_count += 1
+        if node_count > node_limit:
+            return False
+
+        # Spans too small for even the smallest remaining item are wasted, so don't count them.
+        smallest_size = items[-1][1]
+        if remaining_sizes[item_index] > sum(c for c in capacities if c >= smallest_size):
+            return False
+
+        item_size = items[item_index][1]
+        tried_capacities = set()
+        for span_index, capacity in enumerate(capacities):
+            # Putting the item in either of two spans with the same room left leads to the same outcome.
+            if capacity < item_size or capacity in tried_capacities:
+                continue
+            tried_capacities.add(capacity)
+
+            capacities[span_index] -= item_size
+            assignments[item_index] = span_index
+            if search(item_index + 1):
+                return True
+            capacities[span_index] += item_size
+
+        return False
+
+    if not search(0):
+        return None, None
+
+    span_positions = [start for start, _ in spans]
+    placements = {}
+    for item_index, (item_key, item_size) in enumerate(items):
+        span_index = assignments[item_index]
+        placements[item_key] = span_positions[span_index]
+        span_positions[span_index] += item_size
+
+    return placements, f"search ({node_count} nodes)"
+
+
+def get_encoded_instructions(encoded):
+    # Returns the offset and code of each instruction in the encoded event, with None as the code
+    # for each character of text, or None if there's a code whose length isn't known.
+    instructions = []
+
+    offset = 0
+    while offset < len(encoded):
+        value = encoded[offset]
+        if value < 0x20:
+            if value not in EVENT_CODE_INFO:
+                return None
+            instructions.append((offset, value))
+            offset += EVENT_CODE_INFO[value]['length']
+        else:
+            instructions.append((offset, None))
+            offset += 2 if value >= 0xe0 or (value >= 0x80 and value < 0xa0) else 1
+
+    return instructions
+
+
+def get_split_points(encoded):
+    # Returns the offsets where the encoded event can be cut and continued elsewhere, along with
+    # whether the code before the cut can fall through into it (and so needs a jump added). Cuts
+    # only go between whole instructions or characters, and never right after a condition, since
+    # that would make the jump conditional instead of whatever came after it.
+    instructions = get_encoded_instructions(encoded)
+    if instructions is None:
+        return []
+
+    split_points = []
+
+    prev_code = None
+    falls_through = True
+
+    for offset, code in instructions:
+        if offset > 0 and prev_code not in [0x11, 0x12]:
+            split_points.append((offset, falls_through))
+
+        if code is None:
+            falls_through = True
+        else:
+            is_asm_noret = code == 0x15 and encoded[offset+1:offset+3] == b'\x87\xe8'
+            falls_through = prev_code in [0x11, 0x12] or not (code == 0x0f or 'terminator' in EVENT_CODE_INFO[code] or is_asm_noret)
+        prev_code = code
+
+    return split_points
+
+
+def split_encoded_translation(translation_info, split_offset, falls_through, split_addr):
+    first_encoded = translation_info['encoded'][:split_offset]
+    first_references = [(offset, target_addr) for offset, target_addr in translation_info['references'] if offset < split_offset]
+    if falls_through:
+        first_references.append((len(first_encoded) + 1, split_addr))
+        first_encoded += b'\x0f' + int.to_bytes(split_addr, length=2, byteorder='little')
+
+    first_piece = {
+        'encoded': first_encoded,
+        'references': first_references,
+        'locators': { addr: offset for addr, offset in translation_info['locators'].items() if offset < split_offset },
+        'orig_event_addr': translation_info['orig_event_addr']
+    }
+    second_piece = {
+        'encoded': translation_info['encoded'][split_offset:],
+        'references': [(offset - split_offset, target_addr) for offset, target_addr in translation_info['references'] if offset >= split_offset],
+        'locators': { addr: offset - split_offset for addr, offset in translation_info['locators'].items() if offset >= split_offset },
+        'orig_event_addr': translation_info['orig_event_addr']
+    }
+
+    return first_piece, second_piece
+
+
+def get_unused_addrs(event_list, encoded_translations):
+    # Split pieces need an address to be known by until they're relocated. Anything that's already
+    # an event, a locator or the target of a reference is off limits, so these count down from the
+    # top of the address space skipping those.
+    used_addrs = set(event_list.keys()) | set(encoded_translations.keys())
+    for event_info in event_list.values():
+        used_addrs.update(ref_info['target_addr'] for ref_info in event_info['references'])
+        used_addrs.update(ref_info['source_addr'] for ref_info in event_info['references'])
+    for translation_info in encoded_translations.values():
+        used_addrs.update(translation_info['locators'].keys())
+        used_addrs.update(target_addr for _, target_addr in translation_info['references'])
+
+    for addr in range(0xffff, 0, -1):
+        if addr not in used_addrs:
+            yield addr
+
+
+def split_events(event_list, encoded_translations, relocatable_sizes, space_pool):
+    # Places the biggest translations first, best fit. A translation that doesn't fit anywhere is
+    # cut at the last split point that still fits in the biggest free span, and the rest goes back
+    # in line to be placed (and maybe split again) like any other translation. Filling the biggest
+    # span first keeps the number of pieces, and so the number of jumps added, down.
+    split_translations = dict(encoded_translations)
+    unused_addrs = get_unused_addrs(event_list, encoded_translations)
+
+    # A heap, rather than a sorted list, so that putting the rest of a split translation back in line
+    # doesn't mean shifting everything after it.
+    pending = [(-translation_size, translation_addr) for translation_addr, translation_size in relocatable_sizes.items()]
+    heapq.heapify(pending)
+    placements = {}
+    split_count = 0
+    jump_bytes = 0
+
+    while len(pending) > 0:
+        translation_size, translation_addr = heapq.heappop(pending)
+        translation_size = -translation_size
+
+        if translation_size <= space_pool.largest_available_space:
+            placements[translation_addr] = space_pool.take_space(translation_size, 'smallest')
+            continue
+
+        room = space_pool.largest_available_space
+        split_point = None
+        for split_offset, falls_through in get_split_points(split_translations[translation_addr]['encoded']):
+            if split_offset + (3 if falls_through else 0) <= room:
+                split_point = (split_offset, falls_through)
+
+        if split_point is None:
+            raise Exception(f"No space found to relocate event {translation_addr:04x}, even after splitting it")
+
+        split_addr = next(unused_addrs)
+        first_piece, second_piece = split_encoded_translation(split_translations[translation_addr], split_point[0], split_point[1], split_addr)
+        split_translations[translation_addr] = first_piece
+        split_translations[split_addr] = second_piece
+
+        placements[translation_addr] = space_pool.take_space(len(first_piece['encoded']), 'largest')
+
+        split_count += 1
+        jump_bytes += 3 if split_point[1] else 0
+
+        heapq.heappush(pending, (-len(second_piece['encoded']), split_addr))
+
+    return placements, f"split ({split_count} splits, {jump_bytes} bytes of jumps)", split_translations
+
+
+def get_relocatable_addrs(event_list, encoded_translations):
+    return [addr for addr, translation_info in encoded_translations.items() if event_list[translation_info['orig_event_addr']]['is_relocatable']]
+
+
+def merge_translation_suffix(encoded_translations, receiver_addr, donor_addr, shared_length, unused_addrs):
+    receiver = encoded_translations[receiver_addr]
+    donor = encoded_translations[donor_addr]
+
+    donor_instructions = get_encoded_instructions(donor['encoded'])
+    if donor_instructions is None:
+        return 0
+    donor_offsets = set(offset for offset, _ in donor_instructions)
+
+    # Cutting at the very start means the whole receiver is the same as the end of the donor, so
+    # it can be dropped without needing a jump.
+    for cut_offset, falls_through in [(0, False)] + get_split_points(receiver['encoded']):
+        tail_length = len(receiver['encoded']) - cut_offset
+        if tail_length > shared_length:
+            continue
+
+        donor_offset = len(donor['encoded']) - tail_length
+        if donor_offset not in donor_offsets:
+            continue
+
+        # The bytes match, but make sure they're references in both or neither.
+        receiver_references = sorted((offset - cut_offset, target_addr) for offset, target_addr in receiver['references'] if offset >= cut_offset)
+        donor_references = sorted((offset - donor_offset, target_addr) for offset, target_addr in donor['references'] if offset >= donor_offset)
+        if receiver_references != donor_references:
+            continue
+
+        saving = tail_length - (3 if falls_through else 0)
+        if saving <= 0:
+            return 0
+
+        if cut_offset == 0:
+            del encoded_translations[receiver_addr]
+            donor['locators'][receiver_addr] = donor_offset
+            tail_locators = receiver['locators']
+        else:
+            split_addr = next(unused_addrs) if falls_through else None
+            head, tail = split_encoded_translation(receiver, cut_offset, falls_through, split_addr)
+            encoded_translations[receiver_addr] = head
+            if split_addr is not None:
+                donor['locators'][split_addr] = donor_offset
+            tail_locators = tail['locators']
+
+        for locator_addr, locator_offset in tail_locators.items():
+            donor['locators'][locator_addr] = donor_offset + locator_offset
+
+        return saving
+
+    return 0
+
+
+def merge_translation_suffixes(event_list, encoded_translations, unused_addrs):
+    # Translations that end the same way can share one copy of the ending, with the other copy
+    # replaced by a jump into it. Sorting by the reversed bytes puts the translations with the
+    # longest shared endings next to each other. Translations that have given up their ending are
+    # never jumped into, and the ones being jumped into are never cut, so no jump can land in
+    # bytes that have been removed.
+    by_suffix = sorted(get_relocatable_addrs(event_list, encoded_translations), key=lambda addr: (bytes(encoded_translations[addr]['encoded'][::-1]), addr))
+
+    candidates = []
+    for first_addr, second_addr in zip(by_suffix, by_suffix[1:]):
+        first_encoded = encoded_translations[first_addr]['encoded']
+        second_encoded = encoded_translations[second_addr]['encoded']
+
+        shared_length = 0
+        while shared_length < min(len(first_encoded), len(second_encoded)) and first_encoded[-1 - shared_length] == second_encoded[-1 - shared_length]:
+            shared_length += 1
+
+        if shared_length > 3:
+            # Try the shorter one as the receiver first, since it might be dropped entirely.
+            if len(first_encoded) > len(second_encoded):
+                first_addr, second_addr = second_addr, first_addr
+            candidates.append((shared_length, first_addr, second_addr))
+
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1], candidate[2]))
+
+    donor_addrs = set()
+    receiver_addrs = set()
+    saving = 0
+
+    for shared_length, first_addr, second_addr in candidates:
+        for receiver_addr, donor_addr in [(first_addr, second_addr), (second_addr, first_addr)]:
+            if receiver_addr in donor_addrs or receiver_addr in receiver_addrs or donor_addr in receiver_addrs:
+                continue
+
+            receiver_saving = merge_translation_suffix(encoded_translations, receiver_addr, donor_addr, shared_length, unused_addrs)
+            if receiver_saving > 0:
+                donor_addrs.add(donor_addr)
+                receiver_addrs.add(receiver_addr)
+                saving += receiver_saving
+                break
+
+    return saving
+
+
+def build_suffix_array(sequence):
+    # Prefix doubling, which is plenty fast for the amount of text in one sector.
+    suffix_array = list(range(len(sequence)))
+    ranks = list(sequence)
+    prefix_length = 1
+
+    while len(sequence) > 0:
+        def rank_key(index):
+            return (ranks[index], ranks[index + prefix_length] if index + prefix_length < len(sequence) else -1)
+
+        suffix_array.sort(key=rank_key)
+
+        new_ranks = [0] * len(sequence)
+        for sorted_index in range(1, len(suffix_array)):
+            new_ranks[suffix_array[sorted_index]] = new_ranks[suffix_array[sorted_index - 1]] + (rank_key(suffix_array[sorted_index]) != rank_key(suffix_array[sorted_index - 1]))
+        ranks = new_ranks
+
+        if ranks[suffix_array[-1]] == len(sequence) - 1:
+            break
+        prefix_length *= 2
+
+    return suffix_array
+
+
+def build_lcp_array(sequence, suffix_array):
+    # Kasai's algorithm. lcp[i] is the length of the prefix shared by suffix_array[i - 1] and suffix_array[i].
+    ranks = [0] * len(sequence)
+    for sorted_index, index in enumerate(suffix_array):
+        ranks[index] = sorted_index
+
+    lcp = [0] * len(sequence)
+    shared_length = 0
+    for index in range(len(sequence)):
+        if ranks[index] == 0:
+            shared_length = 0
+            continue
+
+        prev_index = suffix_array[ranks[index] - 1]
+        while index + shared_length < len(sequence) and prev_index + shared_length < len(sequence) and sequence[index + shared_length] == sequence[prev_index + shared_length]:
+            shared_length += 1
+        lcp[ranks[index]] = shared_length
+
+        if shared_length > 0:
+            shared_length -= 1
+
+    return lcp
+
+
+def get_text_runs(encoded_translations, translation_addrs):
+    # Runs of half-width text that can be moved into a subroutine as they are. They're broken up
+    # at locators, so that nothing outside ever points into the middle of a subroutine, and they
+    # never start right after a condition.
+    text_runs = []
+
+    for translation_addr in translation_addrs:
+        translation_info = encoded_translations[translation_addr]
+        instructions = get_encoded_instructions(translation_info['encoded'])
+        if instructions is None:
+            continue
+
+        locator_offsets = set(translation_info['locators'].values())
+        run_start = None
+        prev_code = None
+
+        for offset, code in instructions + [(len(translation_info['encoded']), 0x00)]:
+            is_text = code is None and translation_info['encoded'][offset] < 0x7f and prev_code not in [0x11, 0x12]
+
+            if run_start is not None and (not is_text or offset in locator_offsets):
+                text_runs.append((translation_addr, run_start, bytes(translation_info['encoded'][run_start:offset])))
+                run_start = None
+            if run_start is None and is_text:
+                run_start = offset
+
+            prev_code = code
+
+    return text_runs
+
+
+def find_text_subroutine(text_runs, candidate_count=8):
+    # Builds a suffix array over all of the runs, each followed by a separator of its own so no
+    # match can run from one into the next. Each LCP interval is a string that occurs as many
+    # times as there are suffixes in it, which gives an estimate of what it would save.
+    sequence = []
+    positions = []
+    for run_index, (_, _, run_text) in enumerate(text_runs):
+        for run_offset in range(len(run_text)):
+            sequence.append(run_text[run_offset])
+            positions.append((run_index, run_offset))
+        sequence.append(0x100 + run_index)
+        positions.append(None)
+
+    suffix_array = build_suffix_array(sequence)
+    lcp = build_lcp_array(sequence, suffix_array)
 
+    candidates = []
+    stack = [(0, 0)]
+    for sorted_index in range(1, len(sequence) + 1):
+        current_lcp = lcp[sorted_index] if sorted_index < len(sequence) else 0
+        left = sorted_index - 1
+        while stack[-1][0] > current_lcp:
+            shared_length, left = stack.pop()
+            occurrence_count = sorted_index - left
+            estimated_saving = occurrence_count * (shared_length - 3) - (shared_length + 1)
+            if estimated_saving > 0:
+                candidates.append((estimated_saving, shared_length, left, sorted_index))
+        if stack[-1][0] < current_lcp:
+            stack.append((current_lcp, left))
+
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1], candidate[2]))
+
+    # Occurrences can overlap, so the estimate is only good for picking which ones to look at.
+    best = None
+    for _, shared_length, left, right in candidates[:candidate_count]:
+        occurrences = sorted(positions[suffix_array[sorted_index]] for sorted_index in range(left, right))
+
+        kept_occurrences = []
+        for run_index, run_offset in occurrences:
+            if len(kept_occurrences) == 0 or kept_occurrences[-1][0] != run_index or kept_occurrences[-1][1] + shared_length <= run_offset:
+                kept_occurrences.append((run_index, run_offset))
+
+        saving = len(kept_occurrences) * (shared_length - 3) - (shared_length + 1)
+        if saving > 0 and (best is None or saving > best[0]):
+            run_index, run_offset = kept_occurrences[0]
+            best = (saving, text_runs[run_index][2][run_offset:run_offset + shared_length], kept_occurrences)
+
+    return best
+
+
+def replace_with_call(translation_info, offset, length, call_addr):
+    delta = 3 - length
+    translation_info['encoded'] = translation_info['encoded'][:offset] + b'\x10' + int.to_bytes(call_addr, length=2, byteorder='little') + translation_info['encoded'][offset + length:]
+    translation_info['references'] = [(ref_offset + delta if ref_offset >= offset + length else ref_offset, target_addr) for ref_offset, target_addr in translation_info['references']] + [(offset + 1, call_addr)]
+    translation_info['locators'] = { locator_addr: locator_offset + delta if locator_offset >= offset + length else locator_offset for locator_addr, locator_offset in translation_info['locators'].items() }
+
+
+def extract_text_subroutines(event_list, encoded_translations, unused_addrs, max_subroutines=64):
+    # Text that's repeated often enough is moved into a subroutine of its own ending in <RET_IL>,
+    # and every copy is replaced by a <CALL> to it. Only plain text is moved, so there are no
+    # references in it to worry about. The subroutines themselves are left alone, so they never
+    # call each other.
+    translation_addrs = get_relocatable_addrs(event_list, encoded_translations)
+    saving = 0
+    subroutine_count = 0
+
+    while subroutine_count < max_subroutines:
+        text_runs = get_text_runs(encoded_translations, translation_addrs)
+        subroutine = find_text_subroutine(text_runs)
+        if subroutine is None:
+            break
+
+        subroutine_saving, subroutine_text, occurrences = subroutine
+        subroutine_addr = next(unused_addrs)
+
+        # Replace from the back so the earlier offsets in each translation stay put.
+        for run_index, run_offset in reversed(occurrences):
+            translation_addr, run_start, _ = text_runs[run_index]
+            replace_with_call(encoded_translations[translation_addr], run_start + run_offset, len(subroutine_text), subroutine_addr)
+
+        first_translation_addr = text_runs[occurrences[0][0]][0]
+        encoded_translations[subroutine_addr] = { 'encoded': bytearray(subroutine_text + b'\x06'), 'references': [], 'locators': {}, 'orig_event_addr': encoded_translations[first_translation_addr]['orig_event_addr'] }
+
+        saving += subroutine_saving
+        subroutine_count += 1
+
+    return saving, subroutine_count
+
+
+def compress_translations(event_list, encoded_translations):
+    unused_addrs = get_unused_addrs(event_list, encoded_translations)
+
+    suffix_saving = merge_translation_suffixes(event_list, encoded_translations, unused_addrs)
+    subroutine_saving, subroutine_count = extract_text_subroutines(event_list, encoded_translations, unused_addrs)
+
+    print(f"Compression saved {suffix_saving} bytes by sharing endings and {subroutine_saving} bytes with {subroutine_count} subroutines")
+
+
+PACKING_STRATEGIES = ['pack', 'first', 'smallest', 'largest']
+
+
+def place_events(event_list, encoded_translations, empty_space=None, packing_strategy='pack'):
     space_pool = SpacePool()
 
     for event_addr, event_info in event_list.items():
@@ -186,8 +726,7 @@ def relocate_events(event_list, encoded_translations, empty_space=None, packing_
     if empty_space is not None:
         space_pool.add_space(empty_space[0], empty_space[1])
 
-    total_space_required = sum([len(encoded_translations[trans_addr]['encoded']) for trans_addr in encoded_translations])
-    print(f"Requires {total_space_required}/{space_pool.total_available_space} bytes available")
+    relocatable_sizes = {}
 
     for translation_addr, translation_info in encoded_translations.items():
         event_info = event_list[translation_info['orig_event_addr']]
@@ -200,16 +739,96 @@ def relocate_events(event_list, encoded_translations, empty_space=None, packing_
                 raise Exception(f"Encoded text for non-relocatable event at {translation_addr:04x} is too long! original={event_info['length']} bytes; new={len(translation_info['encoded'])} bytes")
             continue
 
+        relocatable_sizes[translation_addr] = len(translation_info['encoded'])
+
+    split_translations = None
+
+    if packing_strategy == 'split':
+        placements, packing_method, split_translations = split_events(event_list, encoded_translations, relocatable_sizes, space_pool)
+    elif packing_strategy == 'pack':
+        placements, packing_method = pack_spans(relocatable_sizes, space_pool.spans)
+        if placements is None:
+            raise Exception(f"No space found to relocate events! Required: {sum(relocatable_sizes.values())} bytes; total available: {space_pool.total_available_space} bytes; largest available: {space_pool.largest_available_space} bytes")
+
+        for translation_addr, space_addr in placements.items():
+            space_pool.take_space_at(space_addr, relocatable_sizes[translation_addr])
+    else:
+        placements = {}
+        packing_method = packing_strategy
+
+        for translation_addr, translation_size in relocatable_sizes.items():
+            try:
+                placements[translation_addr] = space_pool.take_space(translation_size, packing_strategy)
+            except Exception:
+                raise Exception(f"No space found to relocate event {translation_addr:04x}")
+
+    return placements, space_pool, packing_method, split_translations
+
+
+def choose_packing_strategy(event_list, encoded_translations, empty_space=None, preferred_strategy=None):
+    # Returns the strategy along with its placement, so that it doesn't have to be worked out again.
+    # Each sector is already built in its own process, so the strategies are simply tried in turn.
+    def try_strategy(packing_strategy):
         try:
-            space_addr = space_pool.take_space(len(translation_info['encoded']), packing_strategy)
-            relocations[translation_addr] = space_addr
+            return place_events(event_list, encoded_translations, empty_space, packing_strategy)
         except Exception:
-            raise Exception(f"No space found to relocate event {translation_addr:04x}")
+            return None
+
+    # A strategy that worked last time is very likely to work again, so check it on its own first.
+    # Splitting is the exception, since the other strategies might fit without it now.
+    if preferred_strategy is not None and preferred_strategy != 'split':
+        placement = try_strategy(preferred_strategy)
+        if placement is not None:
+            return preferred_strategy, placement
+
+    # Of the strategies that fit, keep whichever leaves the biggest block free for later edits,
+    # going by the order of the list when it's a tie.
+    best_strategy = None
+    best_placement = None
+    for packing_strategy in PACKING_STRATEGIES:
+        placement = try_strategy(packing_strategy)
+        if placement is not None and (best_placement is None or placement[1].largest_available_space > best_placement[1].largest_available_space):
+            best_strategy = packing_strategy
+            best_placement = placement
+
+    # Splitting events costs extra bytes for the jumps, so it's only used when nothing else fits.
+    # If even that doesn't work, it'll produce the error.
+    if best_strategy is None:
+        best_strategy = 'split'
+        best_placement = place_events(event_list, encoded_translations, empty_space, best_strategy)
+
+    return best_strategy, best_placement
+
+
+def relocate_events(event_list, encoded_translations, empty_space=None, packing_strategy='pack', placement=None):
+
+    relocations = {}
+
+    if placement is None:
+        placement = place_events(event_list, encoded_translations, empty_space, packing_strategy)
+    placements, space_pool, packing_method, split_translations = placement
+
+    # Any events that had to be split are swapped out for their pieces, so the caller patches those instead.
+    if split_translations is not None:
+        encoded_translations.clear()
+        encoded_translations.update(split_translations)
+
+    total_space_required = sum([len(encoded_translations[trans_addr]['encoded']) for trans_addr in encoded_translations])
+    total_space_available = space_pool.total_available_space + sum([len(encoded_translations[trans_addr]['encoded']) for trans_addr in placements])
+    print(f"Requires {total_space_required}/{total_space_available} bytes available")
+
+    for translation_addr, translation_info in encoded_translations.items():
+        if translation_addr not in placements:
+            continue
+
+        relocations[translation_addr] = placements[translation_addr]
 
         for locator_orig_addr, locator_new_offset in translation_info['locators'].items():
             locator_new_addr = relocations[translation_addr] + locator_new_offset
             relocations[locator_orig_addr] = locator_new_addr
 
+    print(f"Packed using {packing_method}; {space_pool.total_available_space} bytes left, largest block {space_pool.largest_available_space} bytes")
+    build_profiler.record_budget("events", total_space_required, total_space_available, space_pool.largest_available_space)
     print()
 
     return relocations
@@ -235,35 +854,30 @@ def update_references(event_list, relocations, encoded_translations):
     return reference_changes
 
 
-def patch_sector(patch, sector_addresses, addr, base_addr, data):
-    orig_length = len(data)
-    chunk_index = (addr - base_addr) // 0x400
-    chunk_offset = (addr - base_addr) % 0x400
-    disk_addr = sector_addresses[chunk_index] + chunk_offset
-
-    while len(data) > 0:
-        current_end_addr = min(disk_addr + len(data), sector_addresses[chunk_index] + 0x400)
-        patch.add_record(disk_addr, data[:current_end_addr - disk_addr])
-        data = data[current_end_addr - disk_addr:]
-        chunk_index += 1
-        if len(data) == 0:
-            pass
-        elif chunk_index >= len(sector_addresses):
-            raise Exception(f"Patch data of length {orig_length:x} starting at {addr:04x} cannot fit into the available sectors!")
-        else:
-            disk_addr = None if chunk_index >= len(sector_addresses) else sector_addresses[chunk_index]
+def patch_image(patch, start_addr, available_size, image_file_name, draw_position, magic_offset = 0, gfx_cache=None):
+    # Encoding an image is slow, so the result is cached by the contents of the PNG and everything
+    # else that goes into encoding it. For the same reason, how much the optimal encoder saves over
+    # the greedy one is left to benchmark_gfx.py rather than worked out here.
+    cache_key = hash_bytes(f"{hash_file(image_file_name)}/{draw_position}/{magic_offset}/{ENCODER_VERSION}".encode('utf8'))
+    cached_image = None if gfx_cache is None else gfx_cache.get(cache_key)
 
+    if cached_image is None:
+        planes = load_bitplanes_from_image_file(image_file_name)
 
-def patch_image(patch, start_addr, available_size, image_file_name, draw_position, magic_offset = 0):
-    planes = load_bitplanes_from_image_file(image_file_name)
+        encoded_image = encode_bitplanes(planes, draw_position, magic_offset) + b"\x00"
 
-    encoded_image = encode_bitplanes(planes, draw_position, magic_offset) + b"\x00"
+        if gfx_cache is not None:
+            gfx_cache.set(cache_key, { 'encoded': encoded_image.hex() })
+    else:
+        encoded_image = bytes.fromhex(cached_image['encoded'])
 
     if len(encoded_image) > available_size:
         raise Exception(f"Image loaded from {image_file_name} was encoded to a buffer of {len(encoded_image)} bytes, which does not fit in the available space of {available_size} bytes.")
+
     print(f"Image {image_file_name} used {len(encoded_image)}/{available_size} bytes available.")
+    build_profiler.record_budget(image_file_name, len(encoded_image), available_size)
 
-    patch.add_record(start_addr, encoded_image)
+    patch.add_record(start_addr, encoded_image, origin=image_file_name)
 
     return len(encoded_image)
 
@@ -307,6 +921,7 @@ def event_disk_patch_opening(event_disk_patch):
     else:
         print(f"Opening: {len(encoded_opening)}/{0x585} bytes")
         print()
+    build_profiler.record_budget("opening text", len(encoded_opening), 0x585)
     encoded_opening = encoded_opening.ljust(0x585, b'\x00')
     event_disk_patch.add_record(0x1b572, encoded_opening)
 
@@ -354,12 +969,13 @@ def event_disk_patch_ending(event_disk_patch):
 
 
     print(f"Ending: {initial_available_space - ending_text_pool.total_available_space}/{initial_available_space} bytes")
+    build_profiler.record_budget("ending text", initial_available_space - ending_text_pool.total_available_space, initial_available_space, ending_text_pool.largest_available_space)
     print()
 
 
-def event_disk_patch_gfx(event_disk_patch):
-    first_segment_length = patch_image(event_disk_patch, 0x11610, 0x2400, "gfx/Event/boot_screen_0.png", (10, 48))
-    patch_image(event_disk_patch, 0x11610 + first_segment_length, 0x2400 - first_segment_length, "gfx/Event/boot_screen_1.png", (10, 200))
+def event_disk_patch_gfx(event_disk_patch, gfx_cache=None):
+    first_segment_length = patch_image(event_disk_patch, 0x11610, 0x2400, "gfx/Event/boot_screen_0.png", (10, 48), gfx_cache=gfx_cache)
+    patch_image(event_disk_patch, 0x11610 + first_segment_length, 0x2400 - first_segment_length, "gfx/Event/boot_screen_1.png", (10, 200), gfx_cache=gfx_cache)
     print()
 
 
@@ -594,9 +1210,9 @@ def event_disk_patch_misc(event_disk_patch):
     event_disk_patch.add_record(0x7ad9 + 0x14a10, b'\x03')
 
 
-def program_disk_patch_asm(program_disk_patch, nasm_path):
+def program_disk_patch_asm(program_disk_patch, assembler):
     # Modify the spell name formatter to use half-width digits.
-    patch_asm(program_disk_patch, nasm_path, 0xa041, 0xb, '''
+    patch_asm(program_disk_patch, assembler, 0xa041, 0xb, '''
         mov al,0x31
         add al,[0x4183]
         stosb
@@ -606,7 +1222,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
     ''')
 
     # Modify the first bit of spell/item text to use the passed-in SI instead of just "wa."
-    patch_asm(program_disk_patch, nasm_path, 0xa798, 0x21, '''
+    patch_asm(program_disk_patch, assembler, 0xa798, 0x21, '''
         mov al,[0x417e]
         and al,0x3
         jz orig_a7b3
@@ -633,7 +1249,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
     ''')
 
     # Modify the second half of spell/item text to display the target as the end of a sentence where appropriate.
-    patch_asm(program_disk_patch, nasm_path, 0xa7b9, 0x1d, '''
+    patch_asm(program_disk_patch, assembler, 0xa7b9, 0x1d, '''
         mov si,0x57ed
 
         mov al,[0x417e]
@@ -651,7 +1267,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
     ''')
 
     # Modify the item text to rearrange the order of output.
-    patch_asm(program_disk_patch, nasm_path, 0xa1a5, 0x2a, '''
+    patch_asm(program_disk_patch, assembler, 0xa1a5, 0x2a, '''
         mov si,0x57fe
         call 0xa798
         jc 0xa1da
@@ -672,7 +1288,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
     ''')
 
     # Modify the spell text to rearrange the order of output.
-    patch_asm(program_disk_patch, nasm_path, 0xa1ed, 0x11, '''
+    patch_asm(program_disk_patch, assembler, 0xa1ed, 0x11, '''
         mov si,0x5866
         call 0xa798
         jc short 0xa22b
@@ -682,7 +1298,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
     ''')
 
     # Modify the formatting of the save/load text.
-    patch_asm(program_disk_patch, nasm_path, 0xb2a7, 0x30, '''
+    patch_asm(program_disk_patch, assembler, 0xb2a7, 0x30, '''
         push si
         mov si,0xb2de
         call 0x8559
@@ -711,7 +1327,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
     ''')
 
     # This is the function used to draw compressed text for location names.
-    patch_asm(program_disk_patch, nasm_path, 0x893c, 0x33, '''
+    patch_asm(program_disk_patch, assembler, 0x893c, 0x33, '''
         push dx
         push cx
         push ax
@@ -760,7 +1376,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
 
     # This is a helper function used by the compressed text to load each
     # glyph from the font ROM.
-    patch_asm(program_disk_patch, nasm_path, 0x8a49, 0x50, '''
+    patch_asm(program_disk_patch, assembler, 0x8a49, 0x50, '''
         push di
         push dx
         push cx
@@ -818,7 +1434,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
 
     # This routine decides what text to use in the overworld based on where
     # you are relative to the nearest location entrance.
-    patch_asm(program_disk_patch, nasm_path, 0xa112, 0x6b, '''
+    patch_asm(program_disk_patch, assembler, 0xa112, 0x6b, '''
         ; At this point, di contains a pointer to the coordinates of the nearest location, and
         ; [0xa185] and [0xa187] are the coordinates of the player position.
 
@@ -888,7 +1504,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
     ''')
 
     # Switch the order of outputs in the places that build a concatenated overworld location.
-    patch_asm(program_disk_patch, nasm_path, 0x830a, 0x12, '''
+    patch_asm(program_disk_patch, assembler, 0x830a, 0x12, '''
         mov di,0x68a4
         mov si,0x41bd
         call 0x893c
@@ -897,7 +1513,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
         call 0x6f64
         call 0x893c
     ''')
-    patch_asm(program_disk_patch, nasm_path, 0x7242, 0xf, '''
+    patch_asm(program_disk_patch, assembler, 0x7242, 0xf, '''
         mov si,0x41bd
         call 0x893c
 
@@ -906,6 +1522,8 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
         call 0x893c
     ''')
 
+    assembler.assemble()
+
     # Clear out some unnecessary text concatenation used by the Hyper 2000/Hyper 660 item code.
     program_disk_patch.add_record(0xa73a - 0x4000 + 0x13e10, b'\x90' * 0x6)
 
@@ -915,6 +1533,7 @@ def program_disk_patch_asm(program_disk_patch, nasm_path):
 def program_disk_patch_combat_text(program_disk_patch):
     battle_text_pool = SpacePool()
     battle_text_pool.add_space(0xbf97, 0xbfff)
+    initial_available_space = battle_text_pool.total_available_space
 
     battle_text_relocations = {}
 
@@ -1068,7 +1687,7 @@ def program_disk_patch_combat_text(program_disk_patch):
             program_disk_patch.add_record(battle_text_info['new_addr'] - 0x4000 + 0x13e10, encoded)
 
             for ref_addr in battle_text_info['references']:
-                program_disk_patch.add_record(ref_addr - 0x4000 + 0x13e10, int.to_bytes(battle_text_info['new_addr'], 2, 'little'))
+                program_disk_patch.add_record(ref_addr - 0x4000 + 0x13e10, int.to_bytes(battle_text_info['new_addr'], 2, 'little'), kind='reference')
 
         else:
             reloc_addr = locator_addr_map[battle_text_info['orig_addr']]
@@ -1076,17 +1695,18 @@ def program_disk_patch_combat_text(program_disk_patch):
             battle_text_relocations[battle_text_info['orig_addr']] = reloc_addr
 
             for ref_addr in battle_text_info['references']:
-                program_disk_patch.add_record(ref_addr - 0x4000 + 0x13e10, int.to_bytes(reloc_addr, 2, 'little'))
+                program_disk_patch.add_record(ref_addr - 0x4000 + 0x13e10, int.to_bytes(reloc_addr, 2, 'little'), kind='reference')
 
     print(f"Remaining battle text space: {battle_text_pool.total_available_space} bytes, largest block: {battle_text_pool.largest_available_space} bytes")
+    build_profiler.record_budget("battle text", initial_available_space - battle_text_pool.total_available_space, initial_available_space, battle_text_pool.largest_available_space)
     battle_text_pool.dump()
     print()
 
     return battle_text_relocations
 
 
-def program_disk_patch_gfx(program_disk_patch):
-    patch_image(program_disk_patch, 0x2ea10, 0x1000, "gfx/Program/function_bar.png", (0, 0), 0xc000)
+def program_disk_patch_gfx(program_disk_patch, gfx_cache=None):
+    patch_image(program_disk_patch, 0x2ea10, 0x1000, "gfx/Program/function_bar.png", (0, 0), 0xc000, gfx_cache)
     print()
 
 
@@ -1188,74 +1808,352 @@ def scenario_disk_patch_misc(scenario_disk_patch):
     scenario_disk_patch.add_record(0x10af81, b"\x41")            # Change the base value to a half-width letter
 
 
-def scenario_disk_patch_scenarios(scenario_disk_patch, scenario_disk):
-    scenario_directory = get_scenario_directory(scenario_disk)
-    for scenario_key, scenario_info in scenario_directory.items():
-        scenario_events, scenario_global_refs = extract_scenario_events(scenario_disk, scenario_key, scenario_info)
+def get_sector_inputs(scenario_disk, sector_info, csv_file_name, battle_text_relocations):
+    sector_data = b''
+    for sector_addr in sector_info['sector_addresses']:
+        scenario_disk.seek(sector_addr)
+        sector_data += scenario_disk.read(sector_info['sector_length'])
 
-        if len(scenario_events) == 0:
-            continue
+    return {
+        'csv': hash_file(csv_file_name),
+        'sector': hash_bytes(sector_data),
+        'battle_text': hash_bytes(json.dumps(sorted(battle_text_relocations.items())).encode('ascii')),
+    }
+
+
+def patch_scenario(scenario_disk_patch, scenario_disk, scenario_key, scenario_info, battle_text_relocations, packing_strategy=None, compress_text=False):
+    scenario_events, scenario_global_refs = extract_scenario_events(scenario_disk, scenario_key, scenario_info)
+
+    if len(scenario_events) == 0:
+        return
+
+    print(f"Translating scenario {format_sector_key(scenario_key)}...")
+
+    trans = load_translations_csv(f"csv/Scenarios/{format_sector_key(scenario_key)}.csv")
+    encoded_translations = encode_translations(scenario_events, trans)
+    if compress_text:
+        compress_translations(scenario_events, encoded_translations)
 
-        print(f"Translating scenario {format_sector_key(scenario_key)}...")
+    data_length = scenario_info['sector_length'] * len(scenario_info['sector_addresses'])
+    empty_space = (0xe000 + data_length - scenario_info['space_at_end_length'] + 1, 0xe000 + data_length - 1) if scenario_info['space_at_end_length'] > 0 else None
+    packing_strategy, placement = choose_packing_strategy(scenario_events, encoded_translations, empty_space, packing_strategy)
+    relocations = relocate_events(scenario_events, encoded_translations, placement=placement)
+    reference_changes = update_references(scenario_events, relocations, encoded_translations)
 
-        if scenario_key in [(0x21, 0x01, 0x24), (0x24, 0x00, 0x24), (0x2d, 0x01, 0x23), (0x2f, 0x00, 0x24)]:
-            packing_strategy = 'smallest'
+    sector_patch = SectorMappedPatchBuffer(scenario_info['sector_addresses'], 0xe000)
+
+    for translation_addr, translation in encoded_translations.items():
+        if translation_addr in relocations:
+            sector_patch.add_record(relocations[translation_addr], translation['encoded'], origin=f"event {translation_addr:04x}")
         else:
-            packing_strategy = 'first'
+            sector_patch.add_record(translation_addr, translation['encoded'], origin=f"event {translation_addr:04x}")
 
-        trans = load_translations_csv(f"csv/Scenarios/{format_sector_key(scenario_key)}.csv")
-        encoded_translations = encode_translations(scenario_events, trans)
+    for ref_addr, new_value in reference_changes.items():
+        sector_patch.add_record(ref_addr, int.to_bytes(new_value, length=2, byteorder='little'), origin=f"reference at {ref_addr:04x}", kind='reference')
 
-        data_length = scenario_info['sector_length'] * len(scenario_info['sector_addresses'])
-        empty_space = (0xe000 + data_length - scenario_info['space_at_end_length'] + 1, 0xe000 + data_length - 1) if scenario_info['space_at_end_length'] > 0 else None
-        relocations = relocate_events(scenario_events, encoded_translations, empty_space, packing_strategy)
-        reference_changes = update_references(scenario_events, relocations, encoded_translations)
+    for global_ref in scenario_global_refs:
+        if global_ref['target_addr'] in battle_text_relocations:
+            print(f" Global ref {global_ref['target_addr']:04x} referenced from {global_ref['source_addr']:04x} is being relocated to {battle_text_relocations[global_ref['target_addr']]:04x}")
+            raise Exception("Relocation of global refs in scenarios is not currently implemented.")
 
-        for translation_addr, translation in encoded_translations.items():
-            if translation_addr in relocations:
-                patch_sector(scenario_disk_patch, scenario_info['sector_addresses'], relocations[translation_addr], 0xe000, translation['encoded'])
-            else:
-                patch_sector(scenario_disk_patch, scenario_info['sector_addresses'], translation_addr, 0xe000, translation['encoded'])
+    scenario_disk_patch.add_writes(sector_patch.writes)
+
+    return packing_strategy
+
+
+def patch_combat(scenario_disk_patch, scenario_disk, combat_key, combat_info, battle_text_relocations, packing_strategy=None, compress_text=False):
+    combat_events, combat_global_refs = extract_combat_events(scenario_disk, combat_key, combat_info)
+
+    if len(combat_events) == 0:
+        return
+
+    print(f"Translating combat {format_sector_key(combat_key)}...")
+
+    trans = load_translations_csv(f"csv/Combats/{format_sector_key(combat_key)}.csv")
+    encoded_translations = encode_translations(combat_events, trans)
+    if compress_text:
+        compress_translations(combat_events, encoded_translations)
+
+    data_length = combat_info['sector_length'] * len(combat_info['sector_addresses'])
+    empty_space = (0xdc00 + data_length - combat_info['space_at_end_length'] + 1, 0xdc00 + data_length - 1) if combat_info['space_at_end_length'] > 0 else None
+    packing_strategy, placement = choose_packing_strategy(combat_events, encoded_translations, empty_space, packing_strategy)
+    relocations = relocate_events(combat_events, encoded_translations, placement=placement)
+    reference_changes = update_references(combat_events, relocations, encoded_translations)
+
+    sector_patch = SectorMappedPatchBuffer(combat_info['sector_addresses'], 0xdc00)
+
+    for translation_addr, translation in encoded_translations.items():
+        if translation_addr in relocations:
+            sector_patch.add_record(relocations[translation_addr], translation['encoded'], origin=f"event {translation_addr:04x}")
+        else:
+            sector_patch.add_record(translation_addr, translation['encoded'], origin=f"event {translation_addr:04x}")
+
+    for ref_addr, new_value in reference_changes.items():
+        sector_patch.add_record(ref_addr, int.to_bytes(new_value, length=2, byteorder='little'), origin=f"reference at {ref_addr:04x}", kind='reference')
+
+    for global_ref in combat_global_refs:
+        if global_ref['target_addr'] in battle_text_relocations:
+            sector_patch.add_record(global_ref['source_addr'], int.to_bytes(battle_text_relocations[global_ref['target_addr']], length=2, byteorder='little'), origin=f"battle text reference at {global_ref['source_addr']:04x}", kind='reference')
+
+    scenario_disk_patch.add_writes(sector_patch.writes)
+
+    return packing_strategy
+
+
+def build_writes(patch_func, *args, phase_name=None):
+    # This runs in a worker process, so the output is captured and handed back to be printed by the
+    # caller, along with the worker's profile.
+    log = io.StringIO()
+    patch = PatchBuffer()
+    build_profiler.reset()
+
+    try:
+        with contextlib.redirect_stdout(log), build_profiler.phase(phase_name or patch_func.__name__):
+            result = patch_func(patch, *args)
+    except Exception:
+        print(log.getvalue(), end='')
+        raise
+
+    return patch.writes, log.getvalue(), result, build_profiler.records
+
+
+def patch_sector_from_file(sector_patch, scenario_disk_path, sector_patch_func, sector_key, sector_info, battle_text_relocations, packing_strategy=None, compress_text=False):
+    with open(scenario_disk_path, 'rb') as scenario_disk:
+        return sector_patch_func(sector_patch, scenario_disk, sector_key, sector_info, battle_text_relocations, packing_strategy, compress_text)
+
+
+def patch_sectors(scenario_disk_patch, scenario_disk, sector_type, directory, sector_patch_func, battle_text_relocations, executor, manifest=None, compress_text=False):
+    # Each sector is patched into a patch of its own, so that its writes can be saved in the
+    # manifest and reused as-is by later builds if none of its inputs have changed. The sectors
+    # that do need to be rebuilt are independent of each other, so they're farmed out to the
+    # executor and merged back in sector order to keep the output stable.
+    sector_jobs = []
+
+    for sector_key, sector_info in directory.items():
+        manifest_key = f"{sector_type}/{format_sector_key(sector_key)}"
+        inputs = get_sector_inputs(scenario_disk, sector_info, f"csv/{manifest_key}.csv", battle_text_relocations)
+        inputs['compress_text'] = compress_text
+
+        writes = None if manifest is None else manifest.get_writes(manifest_key, inputs)
+        if writes is None:
+            # The packing strategy that worked last time is passed along even if the inputs have changed,
+            # so the sector only has to search for a new one if it no longer fits.
+            packing_strategy = None if manifest is None else manifest.get_previous_value(manifest_key, 'packing_strategy')
+            future = executor.submit(build_writes, patch_sector_from_file, scenario_disk.name, sector_patch_func, sector_key, sector_info, battle_text_relocations, packing_strategy, compress_text, phase_name=manifest_key)
+        else:
+            future = None
+
+            # The sector isn't rebuilt, but its budgets from when it was are still worth reporting.
+            build_profiler.add_records({ 'phases': [], 'budgets': manifest.get_previous_value(manifest_key, 'budgets') or [] })
+
+        sector_jobs.append( { 'manifest_key': manifest_key, 'inputs': inputs, 'writes': writes, 'future': future } )
 
-        for ref_addr, new_value in reference_changes.items():
-            patch_sector(scenario_disk_patch, scenario_info['sector_addresses'], ref_addr, 0xe000, int.to_bytes(new_value, length=2, byteorder='little'))
+    rebuilt_count = 0
 
-        for global_ref in scenario_global_refs:
-            if global_ref['target_addr'] in battle_text_relocations:
-                print(f" Global ref {global_ref['target_addr']:04x} referenced from {global_ref['source_addr']:04x} is being relocated to {battle_text_relocations[global_ref['target_addr']]:04x}")
-                raise Exception("Relocation of global refs in scenarios is not currently implemented.")
+    for sector_job in sector_jobs:
+        writes = sector_job['writes']
 
+        if sector_job['future'] is not None:
+            writes, log, packing_strategy, profile = sector_job['future'].result()
+            print(log, end='')
+            build_profiler.add_records(profile)
+            rebuilt_count += 1
 
-def scenario_disk_patch_combats(scenario_disk_patch, scenario_disk, battle_text_relocations):
+            if manifest is not None:
+                manifest.set_writes(sector_job['manifest_key'], sector_job['inputs'], writes, packing_strategy=packing_strategy, budgets=profile['budgets'])
+
+        with scenario_disk_patch.origin(sector_job['manifest_key']):
+            scenario_disk_patch.add_writes(writes)
+
+    print(f"{sector_type}: {rebuilt_count}/{len(directory)} sectors rebuilt")
+    print()
+
+
+def scenario_disk_patch_scenarios(scenario_disk_patch, scenario_disk, battle_text_relocations, executor, manifest=None, compress_text=False):
+    scenario_directory = get_scenario_directory(scenario_disk)
+    patch_sectors(scenario_disk_patch, scenario_disk, "Scenarios", scenario_directory, patch_scenario, battle_text_relocations, executor, manifest, compress_text)
+
+
+def scenario_disk_patch_combats(scenario_disk_patch, scenario_disk, battle_text_relocations, executor, manifest=None, compress_text=False):
     combat_directory = get_combat_directory(scenario_disk)
-    for combat_key, combat_info in combat_directory.items():
-        combat_events, combat_global_refs = extract_combat_events(scenario_disk, combat_key, combat_info)
+    patch_sectors(scenario_disk_patch, scenario_disk, "Combats", combat_directory, patch_combat, battle_text_relocations, executor, manifest, compress_text)
 
-        if len(combat_events) == 0:
-            continue
 
-        print(f"Translating combat {format_sector_key(combat_key)}...")
+def event_disk_patch_all(event_disk_patch, gfx_cache_entries=None):
+    gfx_cache = BuildCache(gfx_cache_entries)
 
-        trans = load_translations_csv(f"csv/Combats/{format_sector_key(combat_key)}.csv")
-        encoded_translations = encode_translations(combat_events, trans)
+    for phase_name, patch_func, args in [("opening", event_disk_patch_opening, []), ("ending", event_disk_patch_ending, []), ("gfx", event_disk_patch_gfx, [gfx_cache]), ("misc", event_disk_patch_misc, [])]:
+        with event_disk_patch.origin(patch_func.__name__), build_profiler.phase(phase_name):
+            patch_func(event_disk_patch, *args)
 
-        data_length = combat_info['sector_length'] * len(combat_info['sector_addresses'])
-        empty_space = (0xdc00 + data_length - combat_info['space_at_end_length'] + 1, 0xdc00 + data_length - 1) if combat_info['space_at_end_length'] > 0 else None
-        relocations = relocate_events(combat_events, encoded_translations, empty_space)
-        reference_changes = update_references(combat_events, relocations, encoded_translations)
+    return gfx_cache.used_entries
 
-        for translation_addr, translation in encoded_translations.items():
-            if translation_addr in relocations:
-                patch_sector(scenario_disk_patch, combat_info['sector_addresses'], relocations[translation_addr], 0xdc00, translation['encoded'])
-            else:
-                patch_sector(scenario_disk_patch, combat_info['sector_addresses'], translation_addr, 0xdc00, translation['encoded'])
 
-        for ref_addr, new_value in reference_changes.items():
-            patch_sector(scenario_disk_patch, combat_info['sector_addresses'], ref_addr, 0xdc00, int.to_bytes(new_value, length=2, byteorder='little'))
+def program_disk_patch_all(program_disk_patch, nasm_path, combat_text_writes, asm_cache=None, gfx_cache_entries=None):
+    assembler = AsmBatch(nasm_path, asm_cache)
+    gfx_cache = BuildCache(gfx_cache_entries)
+
+    with program_disk_patch.origin("program_disk_patch_misc"), build_profiler.phase("misc"):
+        program_disk_patch_misc(program_disk_patch)
+    with program_disk_patch.origin("program_disk_patch_asm"), build_profiler.phase("asm"):
+        program_disk_patch_asm(program_disk_patch, assembler)
+    with program_disk_patch.origin("program_disk_patch_gfx"), build_profiler.phase("gfx"):
+        program_disk_patch_gfx(program_disk_patch, gfx_cache)
+    # The combat text was laid out on its own so the scenario disk could have its relocations early,
+    # but its writes still go in at this point, since some of them point into the patched asm.
+    program_disk_patch.add_writes(combat_text_writes)
+    with build_profiler.phase("data tables"):
+        patch_data_table(program_disk_patch, "csv/Items.csv", 0x1491f, 14, 20)
+        patch_data_table(program_disk_patch, "csv/Spells.csv", 0x15243, 8, 11)
+        patch_data_table(program_disk_patch, "csv/Locations.csv", 0x1538d, 12, 12)
+
+    return assembler.cache, gfx_cache.used_entries
+
+
+def program_disk_patch_combat_text_only(program_disk_patch):
+    with program_disk_patch.origin("program_disk_patch_combat_text"):
+        return program_disk_patch_combat_text(program_disk_patch)
+
+
+def report_conflicts(patch, disk_name):
+    conflicts = patch.find_conflicts()
+    if len(conflicts) == 0:
+        return
+
+    # The later write is the one that ends up on the disk, but either way one of them is broken.
+    print(f"Conflicting writes on the {disk_name}:")
+    for start, end, first_origin, second_origin in conflicts:
+        print(f"  {start:06x}~{end:06x}: {first_origin} was overwritten by {second_origin}")
+    print()
+
+
+def write_patch_file(patch, patch_file_name, manifest=None):
+    with build_profiler.phase("encode"):
+        encoded = patch.encode()
+    inputs = { 'patch': hash_bytes(encoded) }
+
+    if manifest is not None and manifest.is_output_current(patch_file_name, inputs):
+        print(f"{patch_file_name} (unchanged)")
+        return
+
+    os.makedirs(os.path.dirname(patch_file_name), exist_ok=True)
+    with open(patch_file_name, 'w+b') as patch_file, build_profiler.phase("write"):
+        patch_file.write(encoded)
+    print(patch_file_name)
+
+    if manifest is not None:
+        manifest.set_output(patch_file_name, inputs)
+
+
+def write_at(out_file, offset, data):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(out_file.fileno(), data, offset)
+    else:
+        out_file.seek(offset)
+        out_file.write(data)
+
+
+def write_patched_disk(patch, source_file_name, output_file_name, manifest=None):
+    with build_profiler.phase("encode"):
+        inputs = { 'source': hash_file(source_file_name), 'patch': hash_bytes(patch.encode()) }
+
+    if manifest is not None and manifest.is_output_current(output_file_name, inputs):
+        print(f"{source_file_name} -> {output_file_name} (unchanged)")
+        return
+
+    # Copy the disk as-is, which the OS can usually do without it passing through here, and then
+    # write only the patched runs into the copy.
+    with build_profiler.phase("apply"):
+        os.makedirs(os.path.dirname(output_file_name), exist_ok=True)
+        shutil.copyfile(source_file_name, output_file_name)
+        with open(output_file_name, 'r+b') as disk_out:
+            for start, data in patch.runs:
+                write_at(disk_out, start, data)
+    print(f"{source_file_name} -> {output_file_name}")
 
-        for global_ref in combat_global_refs:
-            if global_ref['target_addr'] in battle_text_relocations:
-                patch_sector(scenario_disk_patch, combat_info['sector_addresses'], global_ref['source_addr'], 0xdc00, int.to_bytes(battle_text_relocations[global_ref['target_addr']], length=2, byteorder='little'))
+    if manifest is not None:
+        manifest.set_output(output_file_name, inputs)
+
+
+def build_event_disk(config, executor, manifest=None):
+    with build_profiler.phase("event disk"):
+        event_disk_patch = PatchBuffer()
+
+        # Encoded images are cached by the contents of their PNGs, regardless of whether anything else has changed.
+        gfx_cache = None if manifest is None else manifest.get_previous_value('event disk gfx', 'images')
+
+        writes, log, gfx_cache, profile = executor.submit(build_writes, event_disk_patch_all, gfx_cache).result()
+        print(log, end='')
+        build_profiler.add_records(profile)
+        event_disk_patch.add_writes(writes)
+
+        if manifest is not None:
+            manifest.set_entry('event disk gfx', {}, images=gfx_cache)
+        report_conflicts(event_disk_patch, "event disk")
+
+        write_patch_file(event_disk_patch, config['OutputEventDiskPatch'], manifest)
+        write_patched_disk(event_disk_patch, config['OutputEventDiskSource'], config['OutputEventDisk'], manifest)
+
+
+def build_program_disk(config, executor, battle_text_future, manifest=None):
+    with build_profiler.phase("program disk"):
+        program_disk_patch = PatchBuffer()
+
+        # The combat text is cheap to lay out, so it goes first and its relocations are handed to the
+        # scenario disk right away, instead of waiting for the rest of the program disk to finish.
+        try:
+            combat_text_writes, combat_text_log, battle_text_relocations, profile = executor.submit(build_writes, program_disk_patch_combat_text_only, phase_name="combat text").result()
+        except Exception as e:
+            battle_text_future.set_exception(e)
+            raise
+        battle_text_future.set_result(battle_text_relocations)
+        build_profiler.add_records(profile)
+
+        # Assembled snippets are cached by their code and the copy of NASM that built them, and encoded
+        # images by the contents of their PNGs, regardless of whether anything else has changed.
+        asm_cache = None if manifest is None else manifest.get_previous_value('asm', 'encoded')
+        gfx_cache = None if manifest is None else manifest.get_previous_value('program disk gfx', 'images')
+
+        writes, log, (asm_cache, gfx_cache), profile = executor.submit(build_writes, program_disk_patch_all, config['NasmPath'], combat_text_writes, asm_cache, gfx_cache).result()
+        print(log, end='')
+        print(combat_text_log, end='')
+        build_profiler.add_records(profile)
+        program_disk_patch.add_writes(writes)
+
+        if manifest is not None:
+            manifest.set_entry('asm', {}, encoded=asm_cache)
+            manifest.set_entry('program disk gfx', {}, images=gfx_cache)
+        report_conflicts(program_disk_patch, "program disk")
+
+        write_patch_file(program_disk_patch, config['OutputProgramDiskPatch'], manifest)
+        write_patched_disk(program_disk_patch, config['OutputProgramDiskSource'], config['OutputProgramDisk'], manifest)
+
+
+def build_scenario_disk(config, executor, battle_text_future, manifest=None):
+    with build_profiler.phase("scenario disk"):
+        scenario_disk_patch = PatchBuffer()
+        copy_protection_patch = PatchBuffer()
+
+        with scenario_disk_patch.origin("scenario_disk_patch_misc"), build_profiler.phase("misc"):
+            scenario_disk_patch_misc(scenario_disk_patch)
+
+        battle_text_relocations = battle_text_future.result()
+        compress_text = config.getboolean('CompressEventText', fallback=False)
+
+        with open(config['OriginalScenarioDisk'], 'rb') as scenario_disk:
+            with build_profiler.phase("scenarios"):
+                scenario_disk_patch_scenarios(scenario_disk_patch, scenario_disk, battle_text_relocations, executor, manifest, compress_text)
+            with build_profiler.phase("combats"):
+                scenario_disk_patch_combats(scenario_disk_patch, scenario_disk, battle_text_relocations, executor, manifest, compress_text)
+
+        # Build a simple patch that skips some copy protection behavior in scenario 28.00.23
+        copy_protection_patch.add_rle_record(0xb2888, b"\x90", 5)
+
+        report_conflicts(scenario_disk_patch, "scenario disk")
+
+        write_patch_file(scenario_disk_patch, config['OutputScenarioDiskPatch'], manifest)
+        write_patch_file(copy_protection_patch, config['OutputCopyProtectionPatch'], manifest)
+        write_patched_disk(scenario_disk_patch, config['OutputScenarioDiskSource'], config['OutputScenarioDisk'], manifest)
 
 
 if __name__ == '__main__':
@@ -1264,76 +2162,29 @@ if __name__ == '__main__':
     configfile.read("ds6_patch.conf")
     config = configfile['DEFAULT']
 
-    event_disk_patch = ips_util.Patch()
-    program_disk_patch = ips_util.Patch()
-    scenario_disk_patch = ips_util.Patch()
-
-    copy_protection_patch = ips_util.Patch()
-
-
-    # Build the event disk
-    event_disk_patch_opening(event_disk_patch)
-    event_disk_patch_ending(event_disk_patch)
-    event_disk_patch_gfx(event_disk_patch)
-    event_disk_patch_misc(event_disk_patch)
-
-    # Build the program disk
-    program_disk_patch_misc(program_disk_patch)
-    program_disk_patch_asm(program_disk_patch, config['NasmPath'])
-    program_disk_patch_gfx(program_disk_patch)
-    battle_text_relocations = program_disk_patch_combat_text(program_disk_patch)
-    patch_data_table(program_disk_patch, "csv/Items.csv", 0x1491f, 14, 20)
-    patch_data_table(program_disk_patch, "csv/Spells.csv", 0x15243, 8, 11)
-    patch_data_table(program_disk_patch, "csv/Locations.csv", 0x1538d, 12, 12)
-
-    # Build the scenario disk
-    scenario_disk_patch_misc(scenario_disk_patch)
-
-    with open(config['OriginalScenarioDisk'], 'rb') as scenario_disk:
-        scenario_disk_patch_scenarios(scenario_disk_patch, scenario_disk)
-        scenario_disk_patch_combats(scenario_disk_patch, scenario_disk, battle_text_relocations)
-
-    # Build a simple patch that skips some copy protection behavior in scenario 28.00.23
-    copy_protection_patch.add_rle_record(0xb2888, b"\x90", 5)
-
-
-    # Create patch files
-    print("Creating patches...")
-    print(config['OutputEventDiskPatch'])
-    os.makedirs(os.path.dirname(config['OutputEventDiskPatch']), exist_ok=True)
-    open(config['OutputEventDiskPatch'], 'w+b').write(event_disk_patch.encode())
-    print(config['OutputProgramDiskPatch'])
-    os.makedirs(os.path.dirname(config['OutputProgramDiskPatch']), exist_ok=True)
-    open(config['OutputProgramDiskPatch'], 'w+b').write(program_disk_patch.encode())
-    print(config['OutputScenarioDiskPatch'])
-    os.makedirs(os.path.dirname(config['OutputScenarioDiskPatch']), exist_ok=True)
-    open(config['OutputScenarioDiskPatch'], 'w+b').write(scenario_disk_patch.encode())
-    print()
-    print(config['OutputCopyProtectionPatch'])
-    os.makedirs(os.path.dirname(config['OutputCopyProtectionPatch']), exist_ok=True)
-    open(config['OutputCopyProtectionPatch'], 'w+b').write(copy_protection_patch.encode())
-    print()
+    manifest = BuildManifest(config['OutputBuildManifest'], get_code_version([ "build_patch.py", "ds6_build_util.py", "ds6_util.py" ]))
+
+    # Tracing memory slows the build down quite a bit, so it's only done when asked for.
+    profile_memory = config.getboolean('ProfileBuildMemory', fallback=False)
+    if profile_memory:
+        tracemalloc.start()
+
+    # Each disk is built and written by its own thread, which hands the heavy lifting off to the
+    # process pool. The only thing shared between them is the battle text layout, which the program
+    # disk works out first and the scenario disk needs before it can patch any sectors.
+    with ProcessPoolExecutor(initializer=tracemalloc.start if profile_memory else None) as executor, ThreadPoolExecutor(max_workers=3) as disk_executor:
+        battle_text_future = Future()
+
+        disk_futures = [
+            disk_executor.submit(build_event_disk, config, executor, manifest),
+            disk_executor.submit(build_program_disk, config, executor, battle_text_future, manifest),
+            disk_executor.submit(build_scenario_disk, config, executor, battle_text_future, manifest)
+        ]
+
+        for disk_future in disk_futures:
+            disk_future.result()
+
+    manifest.save()
 
-    # Apply patches to disks
-    print("Patching...")
-
-    print(f"{config['OutputEventDiskSource']} -> {config['OutputEventDisk']}")
-    os.makedirs(os.path.dirname(config['OutputEventDisk']), exist_ok=True)
-    with open(config['OutputEventDiskSource'], 'rb') as event_disk_in:
-        disk_bytes = event_disk_in.read()
-    with open(config['OutputEventDisk'], 'w+b') as event_disk_out:
-        event_disk_out.write(event_disk_patch.apply(disk_bytes))
-
-    print(f"{config['OutputProgramDiskSource']} -> {config['OutputProgramDisk']}")
-    os.makedirs(os.path.dirname(config['OutputProgramDisk']), exist_ok=True)
-    with open(config['OutputProgramDiskSource'], 'rb') as program_disk_in:
-        disk_bytes = program_disk_in.read()
-    with open(config['OutputProgramDisk'], 'w+b') as program_disk_out:
-        program_disk_out.write(program_disk_patch.apply(disk_bytes))
-
-    print(f"{config['OutputScenarioDiskSource']} -> {config['OutputScenarioDisk']}")
-    os.makedirs(os.path.dirname(config['OutputScenarioDisk']), exist_ok=True)
-    with open(config['OutputScenarioDiskSource'], 'rb') as scenario_disk_in:
-        disk_bytes = scenario_disk_in.read()
-    with open(config['OutputScenarioDisk'], 'w+b') as scenario_disk_out:
-        scenario_disk_out.write(scenario_disk_patch.apply(disk_bytes))
+    build_profiler.save(config['OutputBuildProfile'])
+    print(config['OutputBuildProfile'])
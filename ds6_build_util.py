@@ -0,0 +1,626 @@
+import bisect
+import contextlib
+import hashlib
+import ips_util
+import itertools
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import tracemalloc
+from tempfile import NamedTemporaryFile
+
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_file(filename):
+    if not os.path.exists(filename):
+        return None
+
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(0x100000), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_code_version(file_names):
+    code_hash = hashlib.sha1()
+    for file_name in file_names:
+        with open(file_name, 'rb') as in_file:
+            code_hash.update(in_file.read())
+    return code_hash.hexdigest()
+
+
+def append_records(patch, records):
+    for record in records:
+        if 'rle_count' in record:
+            patch.add_rle_record(record['address'], record['data'], record['rle_count'])
+        else:
+            patch.add_record(record['address'], record['data'])
+
+
+def encode_writes(writes):
+    return [[address, bytes(data).hex(), origin, kind] for address, data, origin, kind in writes]
+
+
+def decode_writes(encoded):
+    return [(address, bytes.fromhex(data), origin, kind) for address, data, origin, kind in encoded]
+
+
+def get_run_records(start, data):
+    # Splits a run of patched bytes into IPS records, using RLE records for long enough repeats.
+    # These are the same heuristics that ips_util uses when it creates a patch from a diff.
+    records = []
+
+    groups = [{ 'val': key, 'count': sum(1 for _ in group), 'is_last': False } for key, group in itertools.groupby(data)]
+    groups[-1]['is_last'] = True
+
+    record_in_progress = bytearray()
+    pos = start
+
+    for group in groups:
+        if len(record_in_progress) > 0:
+            # Only interrupt a record in progress if the repeat is longer than two record headers.
+            if group['count'] > 13:
+                records.append({ 'address': pos, 'data': bytes(record_in_progress) })
+                pos += len(record_in_progress)
+                record_in_progress = bytearray()
+
+                records.append({ 'address': pos, 'data': bytes([group['val']]), 'rle_count': group['count'] })
+                pos += group['count']
+            else:
+                record_in_progress += bytes([group['val']] * group['count'])
+        elif (group['count'] > 3 and group['is_last']) or group['count'] > 8:
+            remaining_length = group['count']
+            while remaining_length > 0xffff:
+                records.append({ 'address': pos, 'data': bytes([group['val']]), 'rle_count': 0xffff })
+                remaining_length -= 0xffff
+                pos += 0xffff
+
+            records.append({ 'address': pos, 'data': bytes([group['val']]), 'rle_count': remaining_length })
+            pos += remaining_length
+        else:
+            record_in_progress += bytes([group['val']] * group['count'])
+
+        while len(record_in_progress) > 0xffff:
+            records.append({ 'address': pos, 'data': bytes(record_in_progress[:0xffff]) })
+            record_in_progress = record_in_progress[0xffff:]
+            pos += 0xffff
+
+    if len(record_in_progress) > 0:
+        records.append({ 'address': pos, 'data': bytes(record_in_progress) })
+
+    return records
+
+
+def is_expected_overlap(first_kind, second_kind):
+    # Pointing a reference inside some code at whatever it refers to is the whole point of writing
+    # it, and it doesn't matter which of the two was written first.
+    return sorted([first_kind, second_kind]) == ['code', 'reference']
+
+
+def get_differing_stretches(old_bytes, new_bytes):
+    stretches = []
+    for offset, (old_value, new_value) in enumerate(zip(old_bytes, new_bytes)):
+        if old_value != new_value:
+            if len(stretches) > 0 and stretches[-1][1] == offset - 1:
+                stretches[-1] = (stretches[-1][0], offset)
+            else:
+                stretches.append((offset, offset))
+    return stretches
+
+
+class PatchBuffer:
+    # Takes records the same way as an ips_util.Patch, but keeps the patched bytes in an interval
+    # map so that adjacent and overlapping writes are merged. Where writes overlap the later one
+    # wins, same as applying the records in order would. The IPS records are only worked out when
+    # they're asked for, so there are as few of them as possible.
+    #
+    # Every write is also logged along with where it came from, so that writes that step on each
+    # other can be found at the end of the build. Writes also have a kind: 'code', 'reference' for
+    # pointers that are fixed up after the fact, or 'data' for everything else.
+    def __init__(self):
+        self._run_starts = []
+        self._runs = {}
+        self._writes = []
+        self._origins = []
+
+    @property
+    def runs(self):
+        return [(start, bytes(self._runs[start])) for start in self._run_starts]
+
+    @property
+    def records(self):
+        records = []
+        for start, data in self.runs:
+            records += get_run_records(start, data)
+        return records
+
+    @property
+    def writes(self):
+        return list(self._writes)
+
+    @contextlib.contextmanager
+    def origin(self, name):
+        self._origins.append(name)
+        try:
+            yield
+        finally:
+            self._origins.pop()
+
+    def _get_origin(self, origin):
+        names = self._origins + ([] if origin is None else [origin])
+        return " / ".join(names) if len(names) > 0 else "(unknown)"
+
+    def add_record(self, address, data, origin=None, kind='data'):
+        self._write(address, data, self._get_origin(origin), kind)
+
+    def add_rle_record(self, address, data, count, origin=None, kind='data'):
+        self._write(address, bytes(data) * count, self._get_origin(origin), kind)
+
+    def add_writes(self, writes):
+        for address, data, origin, kind in writes:
+            self._write(address, data, self._get_origin(origin), kind)
+
+    def find_conflicts(self):
+        # Replays the writes in order onto a sorted map of which write each byte was last set by, and
+        # compares each write against only the pieces it covers. Each write splits at most two pieces
+        # and replaces the rest, so this stays at O(n log n) however the writes are stacked.
+        conflicts = []
+        piece_starts = []
+        pieces = {}
+
+        for write_index, (address, data, origin, kind) in enumerate(self._writes):
+            end = address + len(data)
+
+            first_index = bisect.bisect_right(piece_starts, address) - 1
+            if first_index < 0 or pieces[piece_starts[first_index]][0] <= address:
+                first_index += 1
+            last_index = bisect.bisect_left(piece_starts, end)
+
+            new_pieces = []
+            for piece_start in piece_starts[first_index:last_index]:
+                piece_end, piece_write_index = pieces.pop(piece_start)
+                piece_address, piece_data, piece_origin, piece_kind = self._writes[piece_write_index]
+
+                overlap_start = max(address, piece_start)
+                overlap_end = min(end, piece_end)
+                new_bytes = data[overlap_start - address:overlap_end - address]
+                old_bytes = piece_data[overlap_start - piece_address:overlap_end - piece_address]
+                if new_bytes != old_bytes and not is_expected_overlap(piece_kind, kind):
+                    for conflict_start, conflict_end in get_differing_stretches(old_bytes, new_bytes):
+                        conflict_start += overlap_start
+                        conflict_end += overlap_start
+
+                        # A write that was cut up by others still only counts once for each stretch.
+                        if len(conflicts) > 0 and conflicts[-1][1] + 1 == conflict_start and conflicts[-1][2:] == (piece_origin, origin):
+                            conflicts[-1] = (conflicts[-1][0], conflict_end, piece_origin, origin)
+                        else:
+                            conflicts.append((conflict_start, conflict_end, piece_origin, origin))
+
+                if piece_start < address:
+                    new_pieces.append((piece_start, address, piece_write_index))
+                if piece_end > end:
+                    new_pieces.append((end, piece_end, piece_write_index))
+
+            new_pieces.append((address, end, write_index))
+            new_pieces.sort()
+
+            piece_starts[first_index:last_index] = [piece_start for piece_start, _, _ in new_pieces]
+            for piece_start, piece_end, piece_write_index in new_pieces:
+                pieces[piece_start] = (piece_end, piece_write_index)
+
+        return sorted(conflicts)
+
+    def _write(self, address, data, origin, kind):
+        if len(data) == 0:
+            return
+
+        self._writes.append((address, bytes(data), origin, kind))
+
+        end = address + len(data)
+
+        # Find every run that overlaps or touches the new data, including one that starts before it.
+        first_index = bisect.bisect_left(self._run_starts, address)
+        if first_index > 0:
+            prev_start = self._run_starts[first_index - 1]
+            if prev_start + len(self._runs[prev_start]) >= address:
+                first_index -= 1
+        last_index = bisect.bisect_right(self._run_starts, end)
+
+        run_start = address
+        run_data = bytearray(data)
+
+        if first_index < last_index:
+            last_start = self._run_starts[last_index - 1]
+            run_start = min(address, self._run_starts[first_index])
+            run_data = bytearray(max(end, last_start + len(self._runs[last_start])) - run_start)
+
+            for start in self._run_starts[first_index:last_index]:
+                old_data = self._runs.pop(start)
+                run_data[start - run_start:start - run_start + len(old_data)] = old_data
+            run_data[address - run_start:end - run_start] = data
+
+            del self._run_starts[first_index:last_index]
+
+        self._run_starts.insert(first_index, run_start)
+        self._runs[run_start] = run_data
+
+    def encode(self):
+        patch = ips_util.Patch()
+        append_records(patch, self.records)
+        return patch.encode()
+
+    def apply(self, in_data):
+        out_data = bytearray(in_data)
+        for start, data in self.runs:
+            if start + len(data) > len(out_data):
+                out_data += bytes(start + len(data) - len(out_data))
+            out_data[start:start + len(data)] = data
+        return out_data
+
+
+class SectorMappedPatchBuffer(PatchBuffer):
+    # Takes writes in the logical addresses of a scenario or combat, and maps them onto the
+    # sectors they're actually stored in when the records are worked out.
+    def __init__(self, sector_addresses, base_addr, sector_length=0x400):
+        super().__init__()
+        self._sector_addresses = sector_addresses
+        self._base_addr = base_addr
+        self._sector_length = sector_length
+
+    @property
+    def runs(self):
+        sector_runs = [sector_run for address, data in super().runs for sector_run in self._map_to_sectors(address, data)]
+
+        # The sectors aren't necessarily in order on the disk, so sort the pieces before merging
+        # the ones that ended up next to each other.
+        disk_runs = []
+        for disk_addr, data in sorted(sector_runs):
+            if len(disk_runs) > 0 and disk_runs[-1][0] + len(disk_runs[-1][1]) == disk_addr:
+                disk_runs[-1] = (disk_runs[-1][0], disk_runs[-1][1] + data)
+            else:
+                disk_runs.append((disk_addr, data))
+
+        return disk_runs
+
+    @property
+    def writes(self):
+        return [(disk_addr, sector_data, origin, kind) for address, data, origin, kind in super().writes for disk_addr, sector_data in self._map_to_sectors(address, data)]
+
+    def _map_to_sectors(self, address, data):
+        offset = address - self._base_addr
+        while len(data) > 0:
+            sector_index, sector_offset = divmod(offset, self._sector_length)
+            length = min(len(data), self._sector_length - sector_offset)
+            yield self._sector_addresses[sector_index] + sector_offset, data[:length]
+            data = data[length:]
+            offset += length
+
+    def _write(self, address, data, origin, kind):
+        if address < self._base_addr or address - self._base_addr + len(data) > self._sector_length * len(self._sector_addresses):
+            raise Exception(f"Patch data of length {len(data):x} starting at {address:04x} cannot fit into the available sectors!")
+        super()._write(address, data, origin, kind)
+
+
+ASM_PREFIXES = {'rep', 'repe', 'repz', 'repne', 'repnz', 'lock', 'o16', 'o32', 'a16', 'a32', 'cs', 'ds', 'es', 'ss', 'fs', 'gs'}
+
+def prefix_asm_labels(asm_code, prefix):
+    # Renames the labels defined in a snippet of asm, along with every use of them in an operand. The
+    # mnemonic (and any prefixes in front of it) is never renamed, so a label can share its name with
+    # an instruction, like "loop". Strings and comments are left alone too.
+    label_pattern = re.compile(r"^(\s*)([A-Za-z_][A-Za-z0-9_]*):")
+    labels = set(re.findall(r"^\s*([A-Za-z_][A-Za-z0-9_]*):", asm_code, re.MULTILINE))
+
+    lines = []
+    for line in asm_code.split("\n"):
+        label_match = label_pattern.match(line)
+        if label_match is None:
+            renamed = ""
+            rest = line
+        else:
+            renamed = f"{label_match.group(1)}{prefix}{label_match.group(2)}:"
+            rest = line[label_match.end():]
+
+        seen_mnemonic = False
+        for token in re.findall(r"'[^']*'|\"[^\"]*\"|`[^`]*`|;.*|[A-Za-z0-9_.$@?]+|.", rest):
+            if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", token):
+                renamed += token
+            elif not seen_mnemonic:
+                seen_mnemonic = token.lower() not in ASM_PREFIXES
+                renamed += token
+            else:
+                renamed += prefix + token if token in labels else token
+        lines.append(renamed)
+
+    return "\n".join(lines)
+
+
+class AsmBatch:
+    # Queues up asm snippets so that they can all be assembled by a single run of NASM. Each snippet
+    # gets a section of its own so that it can have its own origin, and a table of the section lengths
+    # goes on the end of the output so that it can be split back up. Snippets that were assembled
+    # before, by the same version of NASM, are taken from the cache and don't need NASM at all.
+    def __init__(self, nasm_path, cache=None):
+        self._nasm_path = nasm_path
+        self._cache = {} if cache is None else dict(cache)
+        self._used_cache = {}
+        self._snippets = []
+        self._nasm_stamp = None
+
+    @property
+    def cache(self):
+        return dict(self._used_cache)
+
+    def add(self, base_addr, asm_code, on_assembled):
+        self._snippets.append({ 'base_addr': base_addr, 'code': asm_code, 'on_assembled': on_assembled })
+
+    def assemble(self):
+        nasm_stamp = self._get_nasm_stamp()
+
+        pending = []
+        for snippet in self._snippets:
+            snippet['key'] = hash_bytes(f"{nasm_stamp}/{snippet['base_addr']:04x}/{snippet['code']}".encode('utf8'))
+            if snippet['key'] in self._cache:
+                snippet['encoded'] = bytes.fromhex(self._cache[snippet['key']])
+            else:
+                pending.append(snippet)
+
+        if len(pending) > 0:
+            if nasm_stamp is None:
+                raise Exception(f"NASM is not available at the path {self._nasm_path}!")
+
+            for snippet, encoded in zip(pending, self._run_nasm(pending)):
+                snippet['encoded'] = encoded
+
+        for snippet in self._snippets:
+            self._used_cache[snippet['key']] = snippet['encoded'].hex()
+            snippet['on_assembled'](snippet['encoded'])
+
+        self._snippets = []
+
+    def _get_nasm_stamp(self):
+        # The cache is keyed on NASM's version string, so that a different NASM never reuses what an
+        # older one assembled, even if it happens to be installed with the same size and timestamp.
+        if self._nasm_stamp is None and os.path.exists(self._nasm_path):
+            try:
+                result = subprocess.run([self._nasm_path, "-v"], capture_output=True, text=True)
+            except OSError:
+                return None
+            if result.returncode == 0 and result.stdout.strip() != "":
+                self._nasm_stamp = result.stdout.strip()
+        return self._nasm_stamp
+
+    def _run_nasm(self, snippets):
+        # The first snippet goes in .text, so that there's no empty default section left over.
+        section_names = [".text"] + [f"asm{index}" for index in range(1, len(snippets))]
+
+        lines = [ "BITS 16" ]
+        for index, snippet in enumerate(snippets):
+            placement = "" if index == 0 else f" follows={section_names[index - 1]} align=1"
+            lines.append(f"section {section_names[index]}{placement} vstart=0x{snippet['base_addr']:04x}")
+            lines.append(f"__asm{index}_start:")
+
+            # Point any errors at the snippet they came from, rather than a line in the combined file.
+            # Labels are global to the whole file, so each snippet's labels are renamed to keep them
+            # from clashing with another snippet's.
+            lines.append(f"%line 1+1 asm_{snippet['base_addr']:04x}")
+            lines.append(prefix_asm_labels(snippet['code'], f"__asm{index}_"))
+            lines.append(f"__asm{index}_end:")
+
+        lines.append(f"section asm_lengths follows={section_names[-1]} align=1 vstart=0")
+        for index in range(len(snippets)):
+            lines.append(f"dd __asm{index}_end - __asm{index}_start")
+
+        with NamedTemporaryFile(mode="w+", delete=False) as src_file, NamedTemporaryFile(mode="rb", delete=False) as dest_file:
+            src_file_name = src_file.name
+            dest_file_name = dest_file.name
+            src_file.write("\n".join(lines) + "\n")
+
+        try:
+            result = subprocess.run([self._nasm_path, "-f", "bin", src_file_name, "-o", dest_file_name], capture_output=True, text=True)
+            if result.returncode != 0:
+                failed_snippets = sorted(set(re.findall(r"asm_[0-9a-f]{4}", result.stderr)))
+                raise Exception(f"NASM failed to assemble the asm patch at {', '.join(failed_snippets) or 'an unknown address'}:\n{result.stderr}")
+
+            with open(dest_file_name, "rb") as dest_file:
+                output = dest_file.read()
+        finally:
+            os.remove(src_file_name)
+            os.remove(dest_file_name)
+
+        lengths_offset = len(output) - 4 * len(snippets)
+        lengths = [int.from_bytes(output[offset:offset + 4], 'little') for offset in range(lengths_offset, len(output), 4)]
+        if lengths_offset < 0 or sum(lengths) != lengths_offset:
+            raise Exception(f"Couldn't split up the output of NASM ({len(output)} bytes for {len(snippets)} snippets)!")
+
+        encoded = []
+        offset = 0
+        for length in lengths:
+            encoded.append(output[offset:offset + length])
+            offset += length
+        return encoded
+
+
+class BuildProfiler:
+    # Records how long each phase of the build takes and, if tracemalloc is running, the peak memory
+    # during it, along with how much of each space budget was used. Phases can be nested, and each
+    # thread keeps its own stack of them. Memory is traced for the whole process though, so a phase's
+    # peak includes whatever other threads were doing at the same time.
+    #
+    # Worker processes have profilers of their own, which hand back their records to be merged in
+    # under whatever phase the caller is in.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    @property
+    def records(self):
+        with self._lock:
+            return { 'phases': list(self._phases), 'budgets': list(self._budgets) }
+
+    def reset(self):
+        # A forked worker process starts out with a copy of whatever phases were open in the parent,
+        # so those are thrown away too.
+        with self._lock:
+            self._start_time = time.perf_counter()
+            self._phases = []
+            self._budgets = []
+            self._open_phases = []
+        self._local.stack = []
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _get_name(self, name):
+        stack = self._get_stack()
+        return name if len(stack) == 0 else f"{stack[-1]['name']} / {name}"
+
+    def _update_peaks(self):
+        # The peak has to be handed out to every open phase before it's reset for a new one.
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            for phase in self._open_phases:
+                phase['peak_memory'] = max(phase['peak_memory'], peak)
+            tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase = { 'name': self._get_name(name), 'start': time.perf_counter() - self._start_time, 'time': None, 'peak_memory': None }
+
+        with self._lock:
+            self._update_peaks()
+            if tracemalloc.is_tracing():
+                phase['peak_memory'] = tracemalloc.get_traced_memory()[0]
+            self._open_phases.append(phase)
+        self._get_stack().append(phase)
+
+        try:
+            yield
+        finally:
+            phase['time'] = time.perf_counter() - self._start_time - phase['start']
+
+            self._get_stack().pop()
+            with self._lock:
+                self._update_peaks()
+                self._open_phases.remove(phase)
+                self._phases.append(phase)
+
+    def record_budget(self, name, used, available, largest_free=None):
+        budget = { 'name': self._get_name(name), 'used': used, 'available': available, 'largest_free': largest_free }
+        with self._lock:
+            self._budgets.append(budget)
+
+    def add_records(self, records):
+        # The worker's clock started somewhere else, so its phases are lined up to have just finished.
+        offset = time.perf_counter() - self._start_time - max([phase['start'] + phase['time'] for phase in records['phases']], default=0)
+        phases = [dict(phase, name=self._get_name(phase['name']), start=offset + phase['start']) for phase in records['phases']]
+        budgets = [dict(budget, name=self._get_name(budget['name'])) for budget in records['budgets']]
+
+        with self._lock:
+            self._phases += phases
+            self._budgets += budgets
+
+    def save(self, filename):
+        records = self.records
+
+        phases = sorted(records['phases'], key=lambda phase: phase['start'])
+        budgets = [dict(budget, headroom=budget['available'] - budget['used']) for budget in records['budgets']]
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w+', encoding='utf8') as out_file:
+            json.dump({ 'total_time': time.perf_counter() - self._start_time, 'memory_traced': tracemalloc.is_tracing(), 'phases': phases, 'budgets': budgets }, out_file, indent=2)
+
+
+class BuildCache:
+    # Results that depend on nothing but their key, kept from one build to the next. Only the entries
+    # that were used get handed back to be saved, so stale ones drop out.
+    def __init__(self, entries=None):
+        self._entries = {} if entries is None else dict(entries)
+        self._used_entries = {}
+
+    @property
+    def used_entries(self):
+        return dict(self._used_entries)
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._used_entries[key] = value
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = value
+        self._used_entries[key] = value
+
+
+class BuildManifest:
+    def __init__(self, filename, code_version):
+        self._filename = filename
+        self._code_version = code_version
+        self._entries = {}
+        self._used_keys = set()
+        self._lock = threading.Lock()
+
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf8') as in_file:
+                self._entries = json.load(in_file)['entries']
+
+    @property
+    def code_version(self):
+        return self._code_version
+
+    def get_entry(self, key, inputs):
+        with self._lock:
+            self._used_keys.add(key)
+            entry = self._entries.get(key)
+
+        if entry is None or entry['code_version'] != self._code_version or entry['inputs'] != inputs:
+            return None
+        return entry
+
+    def set_entry(self, key, inputs, **values):
+        entry = { 'code_version': self._code_version, 'inputs': inputs }
+        for value_key, value in values.items():
+            entry[value_key] = value
+
+        with self._lock:
+            self._used_keys.add(key)
+            self._entries[key] = entry
+
+    def get_previous_value(self, key, value_key):
+        # Unlike get_entry, this doesn't care whether the entry is still up to date.
+        entry = self._entries.get(key)
+        return None if entry is None else entry.get(value_key)
+
+    def is_output_current(self, file_name, inputs):
+        # The output's own hash is checked too, in case it was changed or deleted since it was written.
+        entry = self.get_entry(f"output/{file_name}", inputs)
+        return entry is not None and entry['hash'] == hash_file(file_name)
+
+    def set_output(self, file_name, inputs):
+        self.set_entry(f"output/{file_name}", inputs, hash=hash_file(file_name))
+
+    def get_writes(self, key, inputs):
+        entry = self.get_entry(key, inputs)
+        return None if entry is None else decode_writes(entry['writes'])
+
+    def set_writes(self, key, inputs, writes, **values):
+        self.set_entry(key, inputs, writes=encode_writes(writes), **values)
+
+    def save(self):
+        # Entries that weren't looked at during this build are stale, so they're dropped.
+        with self._lock:
+            entries = { key: entry for key, entry in self._entries.items() if key in self._used_keys }
+
+        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+        with open(self._filename, 'w+', encoding='utf8') as out_file:
+            json.dump({ 'entries': entries }, out_file, separators=(',', ':'))
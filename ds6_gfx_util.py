@@ -1,50 +1,53 @@
+import numpy as np
 import sys
-from PIL import Image
+
+
+# Bump this whenever a change to the encoder changes what it outputs, so that cached images are
+# encoded again.
+ENCODER_VERSION = 2
+
+SINGLE_BYTES = [bytes((value,)) for value in range(256)]
+
+IMAGE_HEADER_LENGTH = 6
+
+# The pieces of an encoded image, as they're passed to the visitor in read_image_rows.
+IMAGE_ROW = 0
+IMAGE_DIFF_ROW = 1
+IMAGE_DIFF = 2
+IMAGE_RAW = 3
+IMAGE_REPEAT = 4
+
 
 def load_bitplanes_from_image_file(image_file_name):
-    image = Image.open(image_file_name)
+    # PIL is only imported when an image actually needs loading, since cached images don't.
+    from PIL import Image
 
-    planes = [[], [], []]
-    for row in range(image.height):
-        for plane in range(3):
-            planes[plane].append(bytearray(image.width // 8))
-        for col in range(image.width):
-            pixel_color = image.getpixel((col, row))
-            byte_index = col // 8
-            bit_index = 7 - (col % 8)
+    with Image.open(image_file_name) as image:
+        pixels = np.asarray(image.convert("RGB"))
 
-            is_red = pixel_color[0] >= 200
-            is_green = pixel_color[1] >= 200
-            is_blue = pixel_color[2] >= 200
+    return load_bitplanes_from_pixels(pixels)
 
-            if is_red:
-                planes[1][row][byte_index] |= (1 << bit_index)
-            if is_green:
-                planes[2][row][byte_index] |= (1 << bit_index)
-            if is_blue:
-                planes[0][row][byte_index] |= (1 << bit_index)
 
-    return planes
+def load_bitplanes_from_pixels(pixels):
+    # Plane 0 is blue, plane 1 is red and plane 2 is green. Each row of a plane packs eight pixels
+    # into a byte, with the leftmost pixel in the high bit.
+    is_lit = pixels[:, :, [2, 0, 1]] >= 200
+    packed = np.packbits(is_lit, axis=1)[:, :pixels.shape[1] // 8, :]
 
-def load_image_from_bitplanes(planes):
-    width = len(planes[0][0] * 8)
-    height = len(planes[0])
+    return [[bytearray(row) for row in packed[:, :, plane]] for plane in range(3)]
 
-    image = Image.new("RGB", (width, height))
+def load_image_from_bitplanes(planes):
+    from PIL import Image
 
-    for row in range(height):
-        for col in range(width):
-            byte_index = col // 8
-            bit_index = 7 - (col % 8)
-            if byte_index < 0x8000:
+    width = len(planes[0][0]) * 8
+    height = len(planes[0])
 
-                is_red = (planes[1][row][byte_index] & (1 << bit_index) != 0)
-                is_green = (planes[2][row][byte_index] & (1 << bit_index) != 0)
-                is_blue = (planes[0][row][byte_index] & (1 << bit_index) != 0)
+    packed = np.frombuffer(b''.join([bytes(row) for plane in planes for row in plane]), dtype=np.uint8).reshape(3, height, width // 8)
 
-                image.putpixel((col, row), (220 if is_red else 0, 220 if is_green else 0, 220 if is_blue else 0))
+    # Unpack each plane into one value per pixel, then stack them up as the red, green and blue channels.
+    pixels = np.unpackbits(packed, axis=2)[[1, 2, 0]].transpose(1, 2, 0) * np.uint8(220)
 
-    return image
+    return Image.fromarray(pixels)
 
 
 def encode_row_rle(row):
@@ -76,6 +79,49 @@ def encode_row_rle(row):
     return encoded
 
 
+def encode_row_optimal(row):
+    # Finds the shortest mix of segments for the row. A repeat segment is two bytes for up to 0x7f
+    # copies of one byte, and a raw segment is one byte plus up to 0x7f bytes copied as they are.
+    # The row has to start with a repeat segment, since a first byte with the high bit set would
+    # mark it as a diff row instead.
+    costs = [0] + [None] * len(row)
+    choices = [None] * (len(row) + 1)
+
+    repeat_start = 0
+    for end in range(1, len(row) + 1):
+        if row[end - 1] != row[repeat_start]:
+            repeat_start = end - 1
+
+        # A longer prefix never costs less to encode, so the longest repeat allowed is the best one.
+        start = max(repeat_start, end - 0x7f)
+        costs[end] = costs[start] + 2
+        choices[end] = (start, False)
+
+        for start in range(max(end - 0x7f, 1), end):
+            cost = costs[start] + 1 + end - start
+            if cost < costs[end]:
+                costs[end] = cost
+                choices[end] = (start, True)
+
+    segments = []
+    end = len(row)
+    while end > 0:
+        start, is_raw = choices[end]
+        segments.append((start, end, is_raw))
+        end = start
+
+    encoded = bytearray()
+    for start, end, is_raw in reversed(segments):
+        if is_raw:
+            encoded.append((end - start) | 0x80)
+            encoded += row[start:end]
+        else:
+            encoded.append(end - start)
+            encoded.append(row[start])
+
+    return encoded
+
+
 def encode_diffs(planes, original_plane, original_row, new_row_data):
     original_row_data = planes[original_plane][original_row]
 
@@ -107,21 +153,59 @@ def encode_diffs(planes, original_plane, original_row, new_row_data):
         return None
 
 
-def find_optimal_diff(planes, current_row, current_plane):
+def stack_bitplane_rows(planes):
+    # One row of the matrix for each row of each plane, in the order the encoder goes through them.
+    height = len(planes[0])
+    row_bytes = b''.join([bytes(planes[plane][row]) for row in range(height) for plane in range(3)])
+    return np.frombuffer(row_bytes, dtype=np.uint8).reshape(height * 3, len(planes[0][0]))
+
+
+def index_first_rows(stacked_rows):
+    first_rows = {}
+    for index, row in enumerate(stacked_rows):
+        first_rows.setdefault(row.tobytes(), index)
+    return first_rows
+
+
+def find_optimal_diff(planes, current_row, current_plane, stacked_rows=None, first_rows=None):
+    if stacked_rows is None:
+        stacked_rows = stack_bitplane_rows(planes)
+    if first_rows is None:
+        first_rows = index_first_rows(stacked_rows)
+
     new_row_data = planes[current_plane][current_row]
+    current_index = current_row * 3 + current_plane
+
+    # A diff against an identical row is as short as a diff gets, and the earliest one is what a
+    # full search would have picked.
+    first_index = first_rows[stacked_rows[current_index].tobytes()]
+    if first_index < current_index:
+        return encode_diffs(planes, first_index % 3, first_index // 3, new_row_data)
+
+    diff_counts = np.count_nonzero(stacked_rows[:current_index] != stacked_rows[current_index], axis=1)
+    candidates = np.flatnonzero(diff_counts < 0x2a)
+
+    # Each diff takes its own byte, plus an offset byte for every group of up to three of them. That
+    # gives a lower bound on the length of each candidate, so only the ones that could still beat the
+    # best so far are actually encoded. Ties go to the earliest row, the same as a full search.
+    lower_bounds = 2 + diff_counts[candidates] + (diff_counts[candidates] + 2) // 3
 
     best_encoded_diff = None
+    best_index = None
 
-    for row_index in range(current_row + 1):
-        for plane_index in range(current_plane if current_row == row_index else 3):
-            encoded_diff = encode_diffs(planes, plane_index, row_index, new_row_data)
-            if encoded_diff is not None and (best_encoded_diff is None or len(encoded_diff) < len(best_encoded_diff)):
-                best_encoded_diff = encoded_diff
+    for lower_bound, index in sorted(zip(lower_bounds.tolist(), candidates.tolist())):
+        if best_encoded_diff is not None and lower_bound > len(best_encoded_diff):
+            break
+
+        encoded_diff = encode_diffs(planes, index % 3, index // 3, new_row_data)
+        if best_encoded_diff is None or (len(encoded_diff), index) < (len(best_encoded_diff), best_index):
+            best_encoded_diff = encoded_diff
+            best_index = index
 
     return best_encoded_diff
 
 
-def encode_bitplanes(planes, draw_position, magic_offset):
+def encode_bitplanes(planes, draw_position, magic_offset, optimal=True):
 
     width = len(planes[0][0] * 8)
     height = len(planes[0])
@@ -131,10 +215,18 @@ def encode_bitplanes(planes, draw_position, magic_offset):
     encoded += (height * 3).to_bytes(2, byteorder='little')
     encoded += (width // 8).to_bytes(2, byteorder='little')
 
+    stacked_rows = stack_bitplane_rows(planes)
+    first_rows = index_first_rows(stacked_rows)
+
     for row in range(len(planes[0])):
         for plane in range(3):
-            optimal_diff = find_optimal_diff(planes, row, plane)
-            if optimal_diff is None:
+            optimal_diff = find_optimal_diff(planes, row, plane, stacked_rows, first_rows)
+            if optimal:
+                # Diffs are already grouped as tightly as they can be, so it's only a question of
+                # whether the best one beats the best plain encoding of the row.
+                encoded_row = encode_row_optimal(planes[plane][row])
+                encoded += encoded_row if optimal_diff is None or len(encoded_row) < len(optimal_diff) else optimal_diff
+            elif optimal_diff is None:
                 encoded += encode_row_rle(planes[plane][row])
             else:
                 encoded += optimal_diff
@@ -142,143 +234,145 @@ def encode_bitplanes(planes, draw_position, magic_offset):
     return encoded
 
 
-def decode_bitplanes(in_file, magic_offset = 0):
-    start_addr = int.from_bytes(in_file.read(2), byteorder='little')
+def read_image_header(data, offset=0, magic_offset=0):
+    start_addr = int.from_bytes(data[offset:offset + 2], byteorder='little')
+    total_row_count = int.from_bytes(data[offset + 2:offset + 4], byteorder='little')
+    bytes_per_row = int.from_bytes(data[offset + 4:offset + 6], byteorder='little')
 
     start_addr_with_offset = start_addr - magic_offset
     if start_addr_with_offset < 0:
         start_addr_with_offset += 0x10000
 
-    start_x = start_addr_with_offset % 80
-    start_y = start_addr_with_offset // 80
-
-    total_row_count = int.from_bytes(in_file.read(2), byteorder='little')
-    bytes_per_row = int.from_bytes(in_file.read(2), byteorder='little')
+    return start_addr, start_addr_with_offset % 80, start_addr_with_offset // 80, bytes_per_row, total_row_count
 
-    height = total_row_count // 3
 
-    planes = [[], [], []]
+def read_image_rows(data, offset, bytes_per_row, height, planes, visit=None):
+    # Decodes the rows that follow an image header into planes that are already the right size, and
+    # returns where the image ends. If there's a visitor, it's called with each piece of the image
+    # before that piece is written, so it can stop the decoding by raising. Offsets are positions in
+    # the buffer; for rows they're where the row starts, and for everything else they're just past
+    # the end of the piece.
+    # Writing through views means every piece has to be exactly the size it says it is.
+    plane_views = [memoryview(plane) for plane in planes]
 
+    row_start = 0
     for row_index in range(height):
-        for plane_index in range(3):
-            current_row = bytearray()
+        for plane_index, plane in enumerate(plane_views):
+            if visit is not None:
+                visit(IMAGE_ROW, offset, row_index, plane_index)
+
+            count = data[offset]
+            offset += 1
 
-            first_count = int.from_bytes(in_file.read(1), byteorder='little')
+            if count & 0x80:
+                # The byte count also picks the source plane, in steps of 0x2a.
+                source_plane = min((count & 0x7f) // 0x2a, 2)
+                diff_byte_count = (count & 0x7f) - source_plane * 0x2a
+                source_row = data[offset]
+                offset += 1
 
-            is_diff_row = (first_count & 0x80) != 0
+                if visit is not None:
+                    visit(IMAGE_DIFF_ROW, offset, source_plane, source_row, diff_byte_count)
 
-            if is_diff_row:
-                diff_byte_count = first_count & 0x7f
-                source_plane = 0
-                for _ in range(2):
-                    if diff_byte_count >= 0x2a:
-                        diff_byte_count -= 0x2a
-                        source_plane += 1
-                source_row = int.from_bytes(in_file.read(1), byteorder='little')
-                current_row = planes[source_plane][source_row].copy()
+                source_start = source_row * bytes_per_row
+                plane[row_start:row_start + bytes_per_row] = plane_views[source_plane][source_start:source_start + bytes_per_row]
 
                 while diff_byte_count > 0:
-                    diff_length = 1
-                    diff_offset = int.from_bytes(in_file.read(1), byteorder='little')
-                    for _ in range(2):
-                        if diff_offset >= 0x50:
-                            diff_offset -= 0x50
-                            diff_length += 1
-                    diff_bytes = in_file.read(diff_length)
+                    # Likewise, the offset picks the length of the diff, in steps of 0x50.
+                    diff_offset = data[offset]
+                    diff_length = min(diff_offset // 0x50, 2) + 1
+                    diff_offset -= (diff_length - 1) * 0x50
+                    offset += 1 + diff_length
+                    diff_bytes = data[offset - diff_length:offset]
 
-                    current_row[diff_offset:diff_offset+diff_length] = diff_bytes
+                    if visit is not None:
+                        visit(IMAGE_DIFF, offset, diff_offset, diff_bytes)
 
+                    plane[row_start + diff_offset:row_start + diff_offset + diff_length] = diff_bytes
                     diff_byte_count -= diff_length
             else:
-                remaining_bytes = bytes_per_row
-                while remaining_bytes > 0:
-                    if remaining_bytes == bytes_per_row:
-                        count = first_count
-                    else:
-                        count = count = int.from_bytes(in_file.read(1), byteorder='little')
-
-                    if (count & 0x80) != 0:
+                row_pos = row_start
+                row_end = row_start + bytes_per_row
+                while True:
+                    if count & 0x80:
                         # Copy the next n bytes
-                        bytes_to_write = in_file.read(count & 0x7f)
+                        count &= 0x7f
+                        offset += count
+                        raw_bytes = data[offset - count:offset]
+
+                        if visit is not None:
+                            visit(IMAGE_RAW, offset, raw_bytes)
+
+                        plane[row_pos:row_pos + count] = raw_bytes
+                    elif count == 0:
+                        raise Exception("This probably shouldn't happen?")
                     else:
-                        if count == 0:
-                            raise Exception("This probably shouldn't happen?")
                         # Repeat the next byte n times
-                        bytes_to_write = in_file.read(1) * count
-                    current_row += bytes_to_write
-                    remaining_bytes -= len(bytes_to_write)
+                        value = data[offset]
+                        offset += 1
 
-            planes[plane_index].append(current_row)
-
-    return start_x, start_y, planes
+                        if visit is not None:
+                            visit(IMAGE_REPEAT, offset, value, count)
 
+                        plane[row_pos:row_pos + count] = SINGLE_BYTES[value] * count
 
-def explain_encoded_image(in_file, out_file=sys.stdout, magic_offset = 0):
-    start_addr = int.from_bytes(in_file.read(2), byteorder='little')
+                    row_pos += count
+                    if row_pos >= row_end:
+                        break
+                    count = data[offset]
+                    offset += 1
 
-    start_addr_with_offset = start_addr - magic_offset
-    if start_addr_with_offset < 0:
-        start_addr_with_offset += 0x10000
+        row_start += bytes_per_row
 
-    start_x = start_addr_with_offset % 80
-    start_y = start_addr_with_offset // 80
+    return offset
 
-    total_row_count = int.from_bytes(in_file.read(2), byteorder='little')
-    bytes_per_row = int.from_bytes(in_file.read(2), byteorder='little')
 
-    width = bytes_per_row * 8
+def decode_bitplanes_from_buffer(data, offset=0, magic_offset=0):
+    _, start_x, start_y, bytes_per_row, total_row_count = read_image_header(data, offset, magic_offset)
     height = total_row_count // 3
 
-    print(f"Start address is {start_addr:04x} ({start_x, start_y}, offset by {magic_offset:04x})", file=out_file)
-    print(f"Width is {width} ({bytes_per_row} bytes), height is {height} ({total_row_count} rows)", file=out_file)
+    planes = [bytearray(height * bytes_per_row) for _ in range(3)]
+    end_offset = read_image_rows(data, offset + IMAGE_HEADER_LENGTH, bytes_per_row, height, planes)
 
-    for row_index in range(height):
-        for plane_index in range(3):
-            print(f"{in_file.tell():6x} Row {row_index}, plane {plane_index}", file=out_file)
+    rows = [[plane[row * bytes_per_row:(row + 1) * bytes_per_row] for row in range(height)] for plane in planes]
+    return start_x, start_y, rows, end_offset
 
-            first_count = int.from_bytes(in_file.read(1), byteorder='little')
 
-            is_diff_row = (first_count & 0x80) != 0
+def decode_bitplanes(in_file, magic_offset = 0):
+    # The rest of the file is read in one go and decoded from memory, and then the file is left just
+    # past the end of the image, the same as if it had been read piece by piece.
+    start_pos = in_file.tell()
+    start_x, start_y, planes, end_offset = decode_bitplanes_from_buffer(in_file.read(), 0, magic_offset)
+    in_file.seek(start_pos + end_offset)
 
-            if is_diff_row:
-                diff_byte_count = first_count & 0x7f
-                source_plane = 0
-                for _ in range(2):
-                    if diff_byte_count >= 0x2a:
-                        diff_byte_count -= 0x2a
-                        source_plane += 1
-                source_row = int.from_bytes(in_file.read(1), byteorder='little')
-                print(f"       Diff from plane {source_plane} row {source_row}, {diff_byte_count} bytes", file=out_file)
+    return start_x, start_y, planes
 
-                while diff_byte_count > 0:
-                    diff_length = 1
-                    diff_offset = int.from_bytes(in_file.read(1), byteorder='little')
-                    for _ in range(2):
-                        if diff_offset >= 0x50:
-                            diff_offset -= 0x50
-                            diff_length += 1
-                    diff_bytes = in_file.read(diff_length)
 
-                    print(f"{in_file.tell():6x}  Apply diff {diff_bytes.hex()} at offset {diff_offset:02x}", file=out_file)
+def explain_encoded_image(in_file, out_file=sys.stdout, magic_offset = 0):
+    start_pos = in_file.tell()
+    data = in_file.read()
 
-                    diff_byte_count -= diff_length
-            else:
-                remaining_bytes = bytes_per_row
-                while remaining_bytes > 0:
-                    if remaining_bytes == bytes_per_row:
-                        count = first_count
-                    else:
-                        count = count = int.from_bytes(in_file.read(1), byteorder='little')
+    start_addr, start_x, start_y, bytes_per_row, total_row_count = read_image_header(data, 0, magic_offset)
+    print(f"Start address is {start_addr:04x} ({start_x, start_y}, offset by {magic_offset:04x})", file=out_file)
+    print(f"Width is {bytes_per_row * 8} ({bytes_per_row} bytes), height is {total_row_count // 3} ({total_row_count} rows)", file=out_file)
+
+    def explain_piece(piece, offset, *values):
+        pos = start_pos + offset
+
+        if piece == IMAGE_ROW:
+            print(f"{pos:6x} Row {values[0]}, plane {values[1]}", file=out_file)
+        elif piece == IMAGE_DIFF_ROW:
+            print(f"       Diff from plane {values[0]} row {values[1]}, {values[2]} bytes", file=out_file)
+        elif piece == IMAGE_DIFF:
+            print(f"{pos:6x}  Apply diff {bytes(values[1]).hex()} at offset {values[0]:02x}", file=out_file)
+        elif piece == IMAGE_RAW:
+            print(f"{pos:6x}  Write {bytes(values[0]).hex()} ({len(values[0])} bytes encoded directly)", file=out_file)
+        else:
+            print(f"{pos:6x}  Write {(SINGLE_BYTES[values[0]] * values[1]).hex()} (repeated {values[1]} times)", file=out_file)
 
-                    if (count & 0x80) != 0:
-                        # Copy the next n bytes
-                        bytes_to_write = in_file.read(count & 0x7f)
-                        print(f"{in_file.tell():6x}  Write {bytes_to_write.hex()} ({count & 0x7f} bytes encoded directly)", file=out_file)
-                    else:
-                        if count == 0:
-                            raise Exception("This probably shouldn't happen?")
-                        # Repeat the next byte n times
-                        bytes_to_write = in_file.read(1) * count
-                        print(f"{in_file.tell():6x}  Write {bytes_to_write.hex()} (repeated {count} times)", file=out_file)
-                    remaining_bytes -= len(bytes_to_write)
-    print(f"{in_file.tell():6x} Done.", file=out_file)
+    height = total_row_count // 3
+    planes = [bytearray(height * bytes_per_row) for _ in range(3)]
+    end_pos = start_pos + read_image_rows(data, IMAGE_HEADER_LENGTH, bytes_per_row, height, planes, explain_piece)
+
+    print(f"{end_pos:6x} Done.", file=out_file)
+    in_file.seek(end_pos)
@@ -1,4 +1,9 @@
+import array
 import csv
+import functools
+import json
+import os
+import re
 
 from capstone import *
 from capstone.x86 import *
@@ -103,6 +108,10 @@ def disassemble_event(scenario_data, base_addr, start_addr, continuation_extent_
     jumps = set()
 
     while True:
+        # Encoded translations that end with a jump have no terminator.
+        if addr >= len(scenario_data):
+            break
+
         if addr+base_addr in jumps:
             jumps.remove(addr+base_addr)
 
@@ -333,6 +342,36 @@ def encode_event(text, max_length = None):
     return encoded, references, locators
 
 
+def split_translation(event_addr, translation):
+    splits = translation.split("<SPLIT")
+    split_addrs = []
+
+    for split_index in range(len(splits)):
+        if split_index == 0:
+            split_addrs.append(event_addr)
+        else:
+            split_addrs.append(int(splits[split_index][:4], base=16))
+            splits[split_index] = splits[split_index][5:]
+            splits[split_index - 1] += f"<JUMP{split_addrs[split_index]:04x}>"
+
+    return list(zip(split_addrs, splits))
+
+
+@functools.lru_cache(maxsize=None)
+def get_event_instructions(text, event_addr):
+    # Encodes the text and disassembles it starting from the beginning and from each of its locators,
+    # since a locator may only be reachable from outside the event. The result is cached and shared
+    # between callers, so it shouldn't be modified.
+    encoded, _, locators = encode_event(text)
+    locators[event_addr] = 0
+
+    instructions = {}
+    for locator_addr, locator_offset in locators.items():
+        instructions[locator_addr] = disassemble_event(encoded, event_addr, event_addr + locator_offset)
+
+    return instructions
+
+
 class CodeHook:
     def should_handle(self, instruction):
         raise NotImplementedError("Handle this in a subclass")
@@ -1255,6 +1294,12 @@ def explore(data, base_addr, entry_points, hooks):
 def format_sector_key(sector_key):
     return f"{sector_key[0]:02x}.{sector_key[1]:02x}.{sector_key[2]:02x}"
 
+def parse_sector_key(sector_key_str):
+    match = re.search(r"^([0-9a-fA-F]{2})\.([0-9a-fA-F]{2})\.([0-9a-fA-F]{2})$", sector_key_str)
+    if match is None:
+        raise Exception(f"{sector_key_str} is not a valid sector key.")
+    return (int(match.group(1), base=16), int(match.group(2), base=16), int(match.group(3), base=16))
+
 def get_scenario_directory(scenario_disk):
     disk_sectors = get_sector_info_nfd0(scenario_disk)
 
@@ -1595,3 +1640,104 @@ def read_ending_string(in_file):
 		print(e)
 
 	return full_string
+
+
+FLAG_CODE_USAGES = {
+    0x11: 'if_not',
+    0x12: 'if',
+    0x13: 'clear',
+    0x14: 'set',
+}
+
+class FlagIndex:
+    def __init__(self):
+        self._events = []
+        self._flags = {}
+
+    @property
+    def event_count(self):
+        return len(self._events)
+
+    @property
+    def flags(self):
+        return sorted(self._flags.keys())
+
+    def get_event(self, event_id):
+        return self._events[event_id]
+
+    def add_event(self, sector_key, event_addr, instruction_lists):
+        event_id = len(self._events)
+        self._events.append((sector_key, event_addr))
+
+        for instructions in instruction_lists:
+            for instruction in instructions:
+                if 'code' in instruction and instruction['code'] in FLAG_CODE_USAGES:
+                    flag = int.from_bytes(instruction['data'], byteorder='little')
+                    event_ids = self._flags.setdefault(flag, {}).setdefault(FLAG_CODE_USAGES[instruction['code']], array.array('I'))
+
+                    # The same instruction can be seen from more than one locator, so only record each event once.
+                    if len(event_ids) == 0 or event_ids[-1] != event_id:
+                        event_ids.append(event_id)
+
+        return event_id
+
+    def get_usages(self, flag):
+        if flag not in self._flags:
+            return
+
+        for usage in FLAG_CODE_USAGES.values():
+            if usage in self._flags[flag]:
+                for event_id in self._flags[flag][usage]:
+                    yield usage, self._events[event_id]
+
+    def save(self, filename):
+        index_object = {
+            'events': [ format_event_id(sector_key, event_addr) for sector_key, event_addr in self._events ],
+            'flags': { f"{flag:04x}": { usage: event_ids.tolist() for usage, event_ids in self._flags[flag].items() } for flag in self.flags }
+        }
+
+        with open(filename, 'w+', encoding='utf8') as out_file:
+            json.dump(index_object, out_file, separators=(',', ':'))
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r', encoding='utf8') as in_file:
+            index_object = json.load(in_file)
+
+        flag_index = FlagIndex()
+        for event_id_str in index_object['events']:
+            sector_key_str, event_addr_str = event_id_str.split(":")
+            flag_index._events.append((parse_sector_key(sector_key_str), int(event_addr_str, base=16)))
+        for flag_str, usages in index_object['flags'].items():
+            flag_index._flags[int(flag_str, base=16)] = { usage: array.array('I', event_ids) for usage, event_ids in usages.items() }
+
+        return flag_index
+
+
+def format_event_id(sector_key, event_addr):
+    return f"{format_sector_key(sector_key)}:{event_addr:04x}"
+
+
+def build_flag_index(csv_base_path="csv"):
+    flag_index = FlagIndex()
+
+    for sector_type in ["Scenarios", "Combats"]:
+        sector_path = os.path.join(csv_base_path, sector_type)
+        for file_name in sorted(os.listdir(sector_path)):
+            if not file_name.endswith(".csv"):
+                continue
+
+            sector_key = parse_sector_key(file_name[:-4])
+            trans = load_translations_csv(os.path.join(sector_path, file_name))
+
+            for key, trans_info in trans.items():
+                event_addr = int(key, base=16)
+                text = trans_info['translation'] if 'translation' in trans_info else trans_info['original']
+
+                instruction_lists = []
+                for split_addr, split_text in split_translation(event_addr, text):
+                    instruction_lists += get_event_instructions(split_text, split_addr).values()
+
+                flag_index.add_event(sector_key, event_addr, instruction_lists)
+
+    return flag_index
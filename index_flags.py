@@ -0,0 +1,37 @@
+import configparser
+import os
+import sys
+from ds6_util import *
+
+
+if __name__ == '__main__':
+    configfile = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    configfile.read("ds6_patch.conf")
+    config = configfile['DEFAULT']
+
+    # With no arguments, rebuild the index from the translation sheets. With a list
+    # of flags, look them up in the saved index instead.
+    if len(sys.argv) < 2:
+        print("Indexing flags...")
+        flag_index = build_flag_index()
+
+        os.makedirs(os.path.dirname(config['OutputFlagIndex']), exist_ok=True)
+        flag_index.save(config['OutputFlagIndex'])
+
+        print(f"Found {len(flag_index.flags)} flags in {flag_index.event_count} events.")
+        print(config['OutputFlagIndex'])
+    else:
+        flag_index = FlagIndex.load(config['OutputFlagIndex'])
+
+        for flag_str in sys.argv[1:]:
+            flag = int(flag_str, base=16)
+            print(f"Flag {flag:04x}:")
+
+            usage_count = 0
+            for usage, (sector_key, event_addr) in flag_index.get_usages(flag):
+                print(f"  {usage:6} {format_event_id(sector_key, event_addr)}")
+                usage_count += 1
+
+            if usage_count == 0:
+                print("  (Not used)")
+            print()
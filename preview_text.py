@@ -1,8 +1,11 @@
 import configparser
 import culour
 import curses
+import functools
 import re
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from ds6_util import *
 
@@ -136,6 +139,187 @@ class ActiveLeaderPane(Pane):
         super().draw(is_focused)
 
 
+class SectorListPane(Pane):
+    def __init__(self, model, x, y, width, height):
+        super().__init__(model, x, y, width, height)
+
+        self._height = height
+        self._focus_index = model.sector_index
+
+
+    def handle_input(self):
+        ch = super().handle_input()
+
+        sector_count = len(self._model.sector_list)
+        if ch == curses.KEY_DOWN:
+            self._focus_index = (self._focus_index + 1) % sector_count
+        elif ch == curses.KEY_UP:
+            self._focus_index = (self._focus_index - 1) % sector_count
+        elif ch == curses.KEY_NPAGE:
+            self._focus_index = min(self._focus_index + self._height - 1, sector_count - 1)
+        elif ch == curses.KEY_PPAGE:
+            self._focus_index = max(self._focus_index - self._height + 1, 0)
+        elif ch == ord(' ') or ch == ord('\n'):
+            self._model.load_sector_index(self._focus_index)
+
+        return ch
+
+
+    def draw(self, is_focused):
+        self._win.clear()
+
+        self._win.addstr(0, 0, "Sectors", curses.A_REVERSE if is_focused else curses.A_NORMAL)
+
+        # Keep the focused sector in the middle of the list where possible.
+        sector_list = self._model.sector_list
+        visible_count = self._height - 1
+        first_index = min(max(self._focus_index - visible_count // 2, 0), max(len(sector_list) - visible_count, 0))
+
+        for row_index, sector_index in enumerate(range(first_index, min(first_index + visible_count, len(sector_list)))):
+            sector_type, sector_key = sector_list[sector_index]
+
+            if self._focus_index == sector_index:
+                self._win.addstr(1 + row_index, 1, ">")
+            self._win.addstr(1 + row_index, 3, f"{sector_type} {format_sector_key(sector_key)}" +
+                          (" *" if sector_index == self._model.sector_index else ""))
+
+        super().draw(is_focused)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sector_list(scenario_disk_path):
+    # Reading the directories means going through the whole disk, so it's only done once. The list
+    # is shared, so it's a tuple.
+    with open(scenario_disk_path, 'rb') as scenario_disk:
+        scenario_directory = get_scenario_directory(scenario_disk)
+        combat_directory = get_combat_directory(scenario_disk)
+
+    return tuple([("Scenarios", sector_key) for sector_key in sorted(scenario_directory)] +
+                 [("Combats", sector_key) for sector_key in sorted(combat_directory)])
+
+
+class SectorModel:
+    def __init__(self, sector_type, sector_key):
+        self._sector_type = sector_type
+        self._sector_key = sector_key
+        self._trans = load_translations_csv(f"csv/{sector_type}/{format_sector_key(sector_key)}.csv")
+
+        self._key_list = list(self._trans.keys())
+
+        event_instructions = {}
+        condition_set = set()
+        for key in self._key_list:
+            event_instructions.update(get_event_instructions(self.get_raw_translation(key), int(key, base=16)))
+
+        for instructions in event_instructions.values():
+            for instruction in instructions:
+                if 'code' in instruction and instruction['code'] in [0x11, 0x12]:
+                    condition_set.add(int.from_bytes(instruction['data'], byteorder='little'))
+
+        # The condition states belong to the sector, so they're still set when coming back to it.
+        self._condition_list = [ { 'condition': cond, 'state': False } for cond in sorted(condition_set) ]
+
+        # Every jump, call and condition is pointed straight at the instruction list or condition it
+        # refers to, so that rendering an event is only a matter of walking through the lists. The
+        # lists are created up front so that they can be pointed to before they're filled in.
+        condition_infos = { condition_info['condition']: condition_info for condition_info in self._condition_list }
+        self._programs = { locator_addr: [] for locator_addr in event_instructions }
+        for locator_addr, instructions in event_instructions.items():
+            self._programs[locator_addr] += [self._compile_instruction(instruction, condition_infos) for instruction in instructions]
+
+
+    def _compile_instruction(self, instruction, condition_infos):
+        if 'code' not in instruction:
+            return instruction
+
+        code = instruction['code']
+        data = instruction['data']
+        if code == 0x0f or code == 0x10: # Jump, call
+            return { **instruction, 'target': self._programs.get(int.from_bytes(data, byteorder='little')) }
+        elif code == 0x11 or code == 0x12: # If (negated), if
+            return { **instruction, 'condition_info': condition_infos[int.from_bytes(data, byteorder='little')] }
+        elif code == 0x16: # Call based on current leader
+            return { **instruction, 'targets': [self._programs.get(int.from_bytes(data[i:i + 2], byteorder='little')) for i in range(0, len(data), 2)] }
+        else:
+            return instruction
+
+
+    @property
+    def sector_type(self):
+        return self._sector_type
+
+
+    @property
+    def sector_key(self):
+        return self._sector_key
+
+
+    @property
+    def key_list(self):
+        return self._key_list
+
+
+    @property
+    def programs(self):
+        return self._programs
+
+
+    @property
+    def condition_list(self):
+        return self._condition_list
+
+
+    def get_raw_translation(self, key):
+        trans_info = self._trans[key]
+        current_text = trans_info['translation'] if 'translation' in trans_info else trans_info['original']
+        current_text = current_text.replace("\r", "")
+        return current_text
+
+
+class SectorModelCache:
+    # Sector models are built once and kept for as long as the preview is open. Prefetched sectors are
+    # built on a background thread, so that moving to one next to the current sector is instant.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = {}
+
+
+    def get(self, sector_type, sector_key):
+        with self._lock:
+            future = self._futures.get((sector_type, sector_key))
+
+            # A prefetch that hasn't started yet is built right away instead of waiting its turn.
+            if future is not None and future.cancel():
+                future = None
+
+            is_building = future is None
+            if is_building:
+                future = Future()
+                self._futures[(sector_type, sector_key)] = future
+
+        if is_building:
+            try:
+                future.set_result(SectorModel(sector_type, sector_key))
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+
+    def prefetch(self, sectors):
+        with self._lock:
+            for sector_type, sector_key in sectors:
+                if (sector_type, sector_key) not in self._futures:
+                    self._futures[(sector_type, sector_key)] = self._executor.submit(SectorModel, sector_type, sector_key)
+
+
+    def close(self):
+        # Prefetches that haven't started are dropped, and one that's part way through is left to
+        # finish on its own rather than holding up the exit.
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
 class Model:
     def __init__(self, sector_key):
         configfile = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
@@ -151,46 +335,40 @@ class Model:
         self._current_leader_index = 0
         self._roh_in_party = False
 
+        self._sector_list = get_sector_list(self._config['OriginalScenarioDisk'])
+        self._sector_models = SectorModelCache()
+
         self.load_sector(sector_key)
 
 
-    def load_sector(self, sector_key):
-        self._sector_key = sector_key
-        with open(self._config['OriginalScenarioDisk'], 'rb') as scenario_disk:
-            scenario_directory = get_scenario_directory(scenario_disk)
-            combat_directory = get_combat_directory(scenario_disk)
-
-            if sector_key in scenario_directory:
-                self._trans = load_translations_csv(f"csv/Scenarios/{format_sector_key(sector_key)}.csv")
-            elif sector_key in combat_directory:
-                self._trans = load_translations_csv(f"csv/Combats/{format_sector_key(sector_key)}.csv")
-            else:
-                raise Exception(f"Sector key {format_sector_key(sector_key)} is neither a scenario nor a combat.")
+    def close(self):
+        self._sector_models.close()
 
-        self._key_list = list(self._trans.keys())
 
-        self._locators = {}
-        condition_set = set()
-        for key in self._key_list:
-            key_addr = int(key, base=16)
-            current_text = self._get_raw_translation(key)
+    def load_sector(self, sector_key):
+        for sector_index, (_, listed_sector_key) in enumerate(self._sector_list):
+            if listed_sector_key == sector_key:
+                self.load_sector_index(sector_index)
+                return
 
-            encoded_event, _, locators = encode_event(current_text)
-            locators[key_addr] = 0
+        raise Exception(f"Sector key {format_sector_key(sector_key)} is neither a scenario nor a combat.")
 
-            for locator_addr, locator_event_offset in locators.items():
-                self._locators[locator_addr] = { 'key': key_addr, 'offset': locator_event_offset }
 
-                instructions = disassemble_event(encoded_event, key_addr, key_addr + locator_event_offset)
-                for instruction in instructions:
-                    if 'code' in instruction and instruction['code'] in [0x11, 0x12]:
-                        condition_set.add(int.from_bytes(instruction['data'], byteorder='little'))
+    def load_sector_index(self, sector_index):
+        self._sector_index = sector_index
+        self._sector = self._sector_models.get(*self._sector_list[sector_index])
 
-        self._condition_list = [ { 'condition': cond, 'state': False } for cond in sorted(condition_set) ]
+        self._key_list = self._sector.key_list
+        self._programs = self._sector.programs
+        self._condition_list = self._sector.condition_list
         self._focused_condition_index = 0
 
         self.load_translation(0)
 
+        # The sectors either side are the most likely to be looked at next.
+        sector_count = len(self._sector_list)
+        self._sector_models.prefetch([self._sector_list[(sector_index + 1) % sector_count], self._sector_list[(sector_index - 1) % sector_count]])
+
 
     def load_translation(self, index):
         self._display_index = index
@@ -199,12 +377,8 @@ class Model:
         self._formatted_translation = [ [] ]
 
         current_line = ""
-        current_key = self._displayed_key
-        current_key_addr = int(current_key, base=16)
-
-        current_input = self._get_raw_translation(current_key)
-        encoded_input, _, _ = encode_event(current_input)
-        event_iter = iter(disassemble_event(encoded_input, current_key_addr, current_key_addr))
+        instruction_list = self._programs[int(self._displayed_key, base=16)]
+        instruction_index = 0
 
         current_conditional_result = None
 
@@ -214,11 +388,13 @@ class Model:
         call_stack = []
 
         while True:
-            instruction = next(event_iter, None)
-
-            if instruction is None:
+            if instruction_index >= len(instruction_list):
                 break
-            elif 'text' in instruction:
+
+            instruction = instruction_list[instruction_index]
+            instruction_index += 1
+
+            if 'text' in instruction:
                 current_line += instruction['text']
             else:
                 code = instruction['code']
@@ -261,36 +437,29 @@ class Model:
                         current_line = ""
 
                     if len(call_stack) > 0:
-                        return_info = call_stack.pop()
-                        current_key = return_info['key']
-                        event_iter = return_info['iter']
+                        instruction_list, instruction_index = call_stack.pop()
                     else:
                         break
                 elif code == 0x0f: # Jump
                     call_addr = int.from_bytes(data, byteorder='little')
 
                     if current_conditional_result != False:
-                        locator_info = self._locators[call_addr]
-                        instruction_list = self._get_translation_instructions(locator_info['key'], locator_info['offset'])
-                        event_iter = iter(instruction_list)
+                        instruction_list = self._get_target_program(instruction['target'], call_addr)
+                        instruction_index = 0
                     current_conditional_result = None
                 elif code == 0x10: # Call
                     call_addr = int.from_bytes(data, byteorder='little')
 
-                    locator_info = self._locators[call_addr]
-                    call_stack.append( { 'key': current_key, 'iter': event_iter } )
-                    instruction_list = self._get_translation_instructions(locator_info['key'], locator_info['offset'])
-                    event_iter = iter(instruction_list)
+                    call_stack.append( (instruction_list, instruction_index) )
+                    instruction_list = self._get_target_program(instruction['target'], call_addr)
+                    instruction_index = 0
 
                 elif code == 0x11 or code == 0x12: # If (negated), if
                     inverted = code == 0x11
-                    flag = int.from_bytes(data, byteorder='little')
+                    condition = instruction['condition_info']
 
-                    for condition in self._condition_list:
-                        if condition['condition'] == flag:
-                            condition['used_in_current_line'] = True
-                            current_conditional_result = (not condition['state'] if inverted else condition['state'])
-                            break
+                    condition['used_in_current_line'] = True
+                    current_conditional_result = (not condition['state'] if inverted else condition['state'])
                 elif code == 0x16: # Call based on current leader
                     leader_info = self.get_character_info(self._current_leader_index)
 
@@ -302,10 +471,9 @@ class Model:
                     self._formatted_translation[-1].append(current_line)
                     current_line = ""
 
-                    locator_info = self._locators[call_addr]
-                    call_stack.append( { 'key': current_key, 'iter': event_iter } )
-                    instruction_list = self._get_translation_instructions(locator_info['key'], locator_info['offset'])
-                    event_iter = iter(instruction_list)
+                    call_stack.append( (instruction_list, instruction_index) )
+                    instruction_list = self._get_target_program(instruction['targets'][leader_info['text_index']], call_addr)
+                    instruction_index = 0
 
                 elif code in [0x0c, 0x13, 0x14, 0x15]: # Play sound, clear flag, set flag, call asm routine
                     pass
@@ -323,6 +491,16 @@ class Model:
             self._formatted_translation[-1].append(current_line)
 
 
+    @property
+    def sector_list(self):
+        return self._sector_list
+
+
+    @property
+    def sector_index(self):
+        return self._sector_index
+
+
     @property
     def display_index(self):
         return self._display_index
@@ -376,18 +554,10 @@ class Model:
             return self._party_info[character_index][0]
 
 
-    def _get_raw_translation(self, key):
-        trans_info = self._trans[key]
-        current_text = trans_info['translation'] if 'translation' in trans_info else trans_info['original']
-        current_text = current_text.replace("\r", "")
-        return current_text
-
-
-    def _get_translation_instructions(self, translation_key, event_offset):
-        translation = self._get_raw_translation(f"{translation_key:04x}")
-        encoded, _, _ = encode_event(translation)
-        instruction_list = disassemble_event(encoded, translation_key, translation_key + event_offset)
-        return instruction_list
+    def _get_target_program(self, target, call_addr):
+        if target is None:
+            raise Exception(f"Event at {call_addr:04x} isn't in this sector.")
+        return target
 
 
 def curses_main(screen, argv):
@@ -398,26 +568,32 @@ def curses_main(screen, argv):
 
     model = Model(sector_key)
 
-    panes = [
-        TextPreviewPane(model, 2, 1, 36, 8),
-        ConditionListPane(model, 40, 1, 10, 20),
-        ActiveLeaderPane(model, 60, 1, 12, 20)]
-    focused_pane_index = 0
+    try:
+        panes = [
+            TextPreviewPane(model, 2, 1, 36, 8),
+            ConditionListPane(model, 40, 1, 10, 20),
+            ActiveLeaderPane(model, 60, 1, 12, 20),
+            SectorListPane(model, 2, 10, 36, 12)]
+        focused_pane_index = 0
 
-    while True:
+        while True:
 
-        screen.clear()
+            screen.clear()
 
-        for pane_index, pane in enumerate(panes):
-            pane.draw(pane_index == focused_pane_index)
+            for pane_index, pane in enumerate(panes):
+                pane.draw(pane_index == focused_pane_index)
 
-        focused_pane = panes[focused_pane_index]
-        ch = focused_pane.handle_input()
+            focused_pane = panes[focused_pane_index]
+            ch = focused_pane.handle_input()
 
-        if ch == ord('\t'):
-            focused_pane_index = (focused_pane_index + 1) % len(panes)
-        elif ch == ord('q'):
-            break
+            if ch == ord('\t'):
+                focused_pane_index = (focused_pane_index + 1) % len(panes)
+            elif ch == ord('[') or ch == ord(']'):
+                model.load_sector_index((model.sector_index + (1 if ch == ord(']') else -1)) % len(model.sector_list))
+            elif ch == ord('q'):
+                break
+    finally:
+        model.close()
 
 if __name__ == '__main__':
     curses.wrapper(curses_main, sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,126 @@
+import configparser
+import mmap
+import numpy as np
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from ds6_gfx_util import *
+
+
+# Images smaller than this are too easy to find by accident in random data.
+MIN_IMAGE_HEIGHT = 4
+
+
+def find_image_candidates(data):
+    # Checks every offset against the header at once, along with the first byte of the first row,
+    # which can't be a diff since there's nothing yet to diff against.
+    disk_bytes = np.frombuffer(data, dtype=np.uint8)
+    if len(disk_bytes) < 7:
+        return []
+
+    total_row_counts = disk_bytes[2:-4].astype(np.uint32) | (disk_bytes[3:-3].astype(np.uint32) << 8)
+    bytes_per_row = disk_bytes[4:-2].astype(np.uint32) | (disk_bytes[5:-1].astype(np.uint32) << 8)
+    first_counts = disk_bytes[6:]
+
+    is_candidate = (total_row_counts % 3 == 0) & (total_row_counts >= MIN_IMAGE_HEIGHT * 3) & (total_row_counts <= 400 * 3)
+    is_candidate &= (bytes_per_row >= 1) & (bytes_per_row <= 80)
+    is_candidate &= (first_counts >= 1) & (first_counts < 0x80)
+
+    return np.flatnonzero(is_candidate).tolist()
+
+
+def check_encoded_image(data, offset):
+    # Decodes the whole image, but gives up at the first thing that the encoder would never have
+    # written. Returns where the image ends if it makes it that far.
+    _, _, _, bytes_per_row, total_row_count = read_image_header(data, offset)
+    height = total_row_count // 3
+
+    state = { 'row_index': 0, 'plane_index': 0, 'row_length': 0, 'diff_bytes_left': 0 }
+
+    def check_piece(piece, piece_offset, *values):
+        if piece == IMAGE_REPEAT or piece == IMAGE_RAW:
+            state['row_length'] += values[1] if piece == IMAGE_REPEAT else len(values[0])
+            if state['row_length'] > bytes_per_row:
+                raise Exception("Row is too long")
+        elif piece == IMAGE_DIFF:
+            state['diff_bytes_left'] -= len(values[1])
+            if values[0] + len(values[1]) > bytes_per_row or state['diff_bytes_left'] < 0:
+                raise Exception("Diff doesn't fit")
+        elif piece == IMAGE_ROW:
+            if state['diff_bytes_left'] != 0:
+                raise Exception("Diff is the wrong length")
+            state['row_index'], state['plane_index'] = values
+            state['row_length'] = 0
+        else:
+            # Diffs can only be taken from rows that have already been drawn.
+            if (values[1], values[0]) >= (state['row_index'], state['plane_index']):
+                raise Exception("Diff is from a row that hasn't been drawn")
+            state['diff_bytes_left'] = values[2]
+
+    try:
+        planes = [bytearray(height * bytes_per_row) for _ in range(3)]
+        end_offset = read_image_rows(data, offset + IMAGE_HEADER_LENGTH, bytes_per_row, height, planes, check_piece)
+    except Exception:
+        # Running off the end of the disk counts as not being an image too.
+        return None
+
+    return end_offset if state['diff_bytes_left'] == 0 else None
+
+
+def scan_disk(disk_name, disk_file_name, output_path):
+    found_images = []
+
+    with open(disk_file_name, 'rb') as disk_file, mmap.mmap(disk_file.fileno(), 0, access=mmap.ACCESS_READ) as disk_data:
+        data = memoryview(disk_data)
+
+        next_offset = 0
+        for offset in find_image_candidates(data):
+            # Anything that starts inside an image that was already found is part of that image.
+            if offset < next_offset:
+                continue
+
+            end_offset = check_encoded_image(data, offset)
+            if end_offset is None:
+                continue
+
+            start_x, start_y, planes, _ = decode_bitplanes_from_buffer(data, offset)
+            image = load_image_from_bitplanes(planes)
+            image.save(os.path.join(output_path, f"{offset:06x}.png"))
+
+            start_addr = int.from_bytes(data[offset:offset + 2], byteorder='little')
+            found_images.append({ 'offset': offset, 'end_offset': end_offset, 'start_addr': start_addr, 'width': image.width, 'height': image.height })
+            next_offset = end_offset
+
+        data.release()
+
+    return disk_name, found_images
+
+
+if __name__ == '__main__':
+    configfile = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    configfile.read("ds6_patch.conf")
+    config = configfile['DEFAULT']
+
+    disks = { 'Event': config['OriginalEventDisk'], 'Program': config['OriginalProgramDisk'], 'Scenario': config['OriginalScenarioDisk'] }
+
+    start_time = time.perf_counter()
+
+    with ProcessPoolExecutor() as executor:
+        scan_futures = []
+        for disk_name, disk_file_name in disks.items():
+            output_path = os.path.join(config['OutputGfxScanPath'], disk_name)
+            os.makedirs(output_path, exist_ok=True)
+            scan_futures.append(executor.submit(scan_disk, disk_name, disk_file_name, output_path))
+
+        for scan_future in scan_futures:
+            disk_name, found_images = scan_future.result()
+
+            print(f"{disk_name} disk: {len(found_images)} images")
+            for image_info in found_images:
+                # The start address is left as it is, since some images are drawn with an offset that
+                # isn't stored with them.
+                print(f"  {image_info['offset']:6x}~{image_info['end_offset']:x} - {image_info['width']}x{image_info['height']}, start address {image_info['start_addr']:04x}")
+            print()
+
+    print(f"Scanned {len(disks)} disks in {time.perf_counter() - start_time:.2f} seconds")
+    print(config['OutputGfxScanPath'])
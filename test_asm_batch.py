@@ -0,0 +1,98 @@
+import os
+import shutil
+import subprocess
+import pytest
+from build_patch import *
+
+NASM_PATH = shutil.which("nasm")
+
+# Two snippets with a label each of the same name, one of which is also the name of an instruction.
+CLASHING_SNIPPETS = [
+    (0x5000, """
+    loop:
+        dec cx
+        jnz loop
+        loop loop
+        ret
+"""),
+    (0x6000, """
+        mov cx, 4
+    loop:
+        rep movsb
+        loop loop
+        jmp short loop
+        db 'loop', 0 ; loop
+"""),
+]
+
+
+class SnippetRecorder:
+    def __init__(self):
+        self.snippets = []
+
+    def add(self, base_addr, asm_code, on_assembled):
+        self.snippets.append((base_addr, asm_code))
+
+    def assemble(self):
+        pass
+
+
+def assemble_alone(tmp_path, base_addr, asm_code):
+    src_file_name = os.path.join(tmp_path, "snippet.asm")
+    dest_file_name = os.path.join(tmp_path, "snippet.bin")
+    with open(src_file_name, "w") as src_file:
+        src_file.write(f"BITS 16\norg 0x{base_addr:04x}\n\n{asm_code}")
+
+    subprocess.run([NASM_PATH, "-f", "bin", src_file_name, "-o", dest_file_name], check=True)
+    with open(dest_file_name, "rb") as dest_file:
+        return dest_file.read()
+
+
+def test_labels_named_like_instructions_are_only_renamed_as_labels():
+    renamed = prefix_asm_labels(CLASHING_SNIPPETS[1][1], "__asm1_")
+
+    assert "__asm1_loop:" in renamed
+    assert "rep movsb" in renamed
+    assert "loop __asm1_loop" in renamed
+    assert "jmp short __asm1_loop" in renamed
+    assert "db 'loop', 0 ; loop" in renamed
+
+
+def test_only_defined_labels_are_renamed():
+    renamed = prefix_asm_labels("start:\n    mov ax, es:[start]\n    call far [cs:table]\n", "__asm0_")
+
+    assert renamed == "__asm0_start:\n    mov ax, es:[__asm0_start]\n    call far [cs:table]\n"
+
+
+def test_cache_is_keyed_on_nasm_version(monkeypatch):
+    nasm_runs = []
+    def run_nasm(self, snippets):
+        nasm_runs.append(len(snippets))
+        return [b'\x90' for _ in snippets]
+    monkeypatch.setattr(AsmBatch, "_run_nasm", run_nasm)
+
+    cache = None
+    for nasm_version in ["NASM version 2.15.05", "NASM version 2.15.05", "NASM version 2.16.01"]:
+        monkeypatch.setattr(AsmBatch, "_get_nasm_stamp", lambda self: nasm_version)
+        batch = AsmBatch("nasm", cache)
+        batch.add(0x5000, "nop", lambda encoded: None)
+        batch.assemble()
+        cache = batch.cache
+
+    assert nasm_runs == [1, 1]
+
+
+@pytest.mark.skipif(NASM_PATH is None, reason="NASM is not installed")
+def test_batched_output_matches_assembling_each_snippet_alone(tmp_path):
+    recorder = SnippetRecorder()
+    program_disk_patch_asm(PatchBuffer(), recorder)
+    snippets = recorder.snippets + CLASHING_SNIPPETS
+
+    batched = {}
+    batch = AsmBatch(NASM_PATH)
+    for base_addr, asm_code in snippets:
+        batch.add(base_addr, asm_code, lambda encoded, base_addr=base_addr: batched.__setitem__(base_addr, encoded))
+    batch.assemble()
+
+    for base_addr, asm_code in snippets:
+        assert batched[base_addr] == assemble_alone(tmp_path, base_addr, asm_code)
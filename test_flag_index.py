@@ -0,0 +1,60 @@
+import os
+from build_patch import *
+
+
+def find_flags_naively(csv_base_path="csv"):
+    # Reads every instruction in each event's bytes in order, whether or not anything can reach it.
+    usages = {}
+
+    for sector_type in ["Scenarios", "Combats"]:
+        sector_path = os.path.join(csv_base_path, sector_type)
+        for file_name in sorted(os.listdir(sector_path)):
+            if not file_name.endswith(".csv"):
+                continue
+
+            sector_key = parse_sector_key(file_name[:-4])
+            for key, trans_info in load_translations_csv(os.path.join(sector_path, file_name)).items():
+                text = trans_info['translation'] if 'translation' in trans_info else trans_info['original']
+                for _, split_text in split_translation(int(key, base=16), text):
+                    encoded, _, _ = encode_event(split_text)
+                    for offset, code in get_encoded_instructions(encoded):
+                        if code in FLAG_CODE_USAGES:
+                            flag = int.from_bytes(encoded[offset + 1:offset + 3], byteorder='little')
+                            usages.setdefault(flag, set()).add((FLAG_CODE_USAGES[code], (sector_key, int(key, base=16))))
+
+    return usages
+
+
+def test_index_matches_scanning_every_event():
+    flag_index = build_flag_index()
+
+    assert { flag: set(flag_index.get_usages(flag)) for flag in flag_index.flags } == find_flags_naively()
+
+
+def test_events_seen_from_several_locators_are_recorded_once():
+    flag_index = FlagIndex()
+    text = "<SET0012>Hi<LOC1004><CLEAR0012><IF_NOT0034>Bye<END>\n"
+    flag_index.add_event((0x11, 0x00, 0x20), 0x1000, get_event_instructions(text, 0x1000).values())
+    flag_index.add_event((0x11, 0x00, 0x20), 0x2000, get_event_instructions("<IF0012><CLEAR0012><END>\n", 0x2000).values())
+
+    assert flag_index.flags == [0x12, 0x34]
+    assert list(flag_index.get_usages(0x12)) == [
+        ('if', ((0x11, 0x00, 0x20), 0x2000)),
+        ('clear', ((0x11, 0x00, 0x20), 0x1000)),
+        ('clear', ((0x11, 0x00, 0x20), 0x2000)),
+        ('set', ((0x11, 0x00, 0x20), 0x1000))]
+    assert list(flag_index.get_usages(0x34)) == [('if_not', ((0x11, 0x00, 0x20), 0x1000))]
+    assert list(flag_index.get_usages(0x56)) == []
+
+
+def test_saved_index_loads_back_the_same(tmp_path):
+    flag_index = build_flag_index()
+    file_name = os.path.join(tmp_path, "flag_index.json")
+    flag_index.save(file_name)
+
+    loaded_index = FlagIndex.load(file_name)
+
+    assert loaded_index.event_count == flag_index.event_count
+    assert loaded_index.flags == flag_index.flags
+    for flag in flag_index.flags:
+        assert list(loaded_index.get_usages(flag)) == list(flag_index.get_usages(flag))
@@ -0,0 +1,94 @@
+import random
+from build_patch import *
+
+
+def merge_spans(spans):
+    # The greedy passes go through a SpacePool, which merges spans that touch.
+    merged = []
+    for start, end in sorted(spans):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def check_placements(item_sizes, spans, placements):
+    assert set(placements) == set(item_sizes)
+
+    placed = sorted((placements[item_key], placements[item_key] + item_size - 1) for item_key, item_size in item_sizes.items())
+    for (start, end), (next_start, _) in zip(placed, placed[1:]):
+        assert end < next_start
+
+    merged_spans = merge_spans(spans)
+    for start, end in placed:
+        assert any(span_start <= start and end <= span_end for span_start, span_end in merged_spans)
+
+
+def make_spans(rng, span_count, max_size, min_gap=0):
+    spans = []
+    addr = 0x1000
+    for _ in range(span_count):
+        size = rng.randint(1, max_size)
+        spans.append((addr, addr + size - 1))
+        addr += size + rng.randint(min_gap, 4)
+    return spans
+
+
+def make_items(rng, spans, max_size):
+    target_size = sum(end - start + 1 for start, end in spans) * rng.uniform(0.7, 0.95)
+    item_sizes = {}
+    while sum(item_sizes.values()) < target_size:
+        item_sizes[len(item_sizes)] = rng.randint(1, max_size)
+    return item_sizes
+
+
+def test_placements_fit_in_spans_without_overlapping():
+    rng = random.Random(31)
+
+    for _ in range(300):
+        spans = make_spans(rng, rng.randint(1, 8), 40)
+        item_sizes = make_items(rng, spans, 12)
+
+        placements, packing_method = pack_spans(item_sizes, spans)
+        if placements is None:
+            assert packing_method is None
+        else:
+            check_placements(item_sizes, spans, placements)
+
+
+def test_search_packs_spans_cut_into_pieces():
+    rng = random.Random(310)
+
+    for _ in range(200):
+        # Every span is cut up into items that exactly fill it, so there's always a packing to find,
+        # though the greedy passes often miss it. Gaps keep the spans from being merged.
+        spans = make_spans(rng, rng.randint(2, 4), 24, min_gap=1)
+        item_sizes = {}
+        for start, end in spans:
+            size_left = end - start + 1
+            while size_left > 0:
+                item_size = min(size_left, rng.randint(1, 10))
+                item_sizes[len(item_sizes)] = item_size
+                size_left -= item_size
+
+        placements, _ = pack_spans(item_sizes, spans, node_limit=100000)
+        check_placements(item_sizes, spans, placements)
+
+
+def test_search_is_used_when_greedy_passes_fail():
+    # Both greedy passes put the two 4s together, leaving no room for the last 3.
+    item_sizes = { 'a': 4, 'b': 4, 'c': 3, 'd': 3, 'e': 3, 'f': 3 }
+    spans = [(0x100, 0x109), (0x200, 0x209)]
+
+    placements, packing_method = pack_spans(item_sizes, spans)
+
+    assert packing_method.startswith("search")
+    check_placements(item_sizes, spans, placements)
+
+
+def test_too_little_space_is_not_packed():
+    placements, packing_method = pack_spans({ 'a': 8, 'b': 8 }, [(0x100, 0x10e)])
+
+    assert placements is None
+    assert packing_method is None
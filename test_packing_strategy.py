@@ -0,0 +1,83 @@
+import contextlib
+import io
+import random
+from build_patch import *
+
+
+def make_sector(rng, event_count, growth):
+    event_list = {}
+    encoded_translations = {}
+
+    addr = 0x1000
+    for _ in range(event_count):
+        length = rng.randint(4, 60)
+        event_list[addr] = { 'is_relocatable': True, 'length': length, 'references': [] }
+        encoded_length = max(2, int(length * rng.uniform(1 - growth, 1 + growth)))
+        encoded_translations[addr] = { 'encoded': bytearray(b'a' * (encoded_length - 1) + b'\x00'), 'orig_event_addr': addr, 'locators': {}, 'references': [] }
+        addr += length + rng.randint(0, 5)
+
+    return event_list, encoded_translations
+
+
+def check_relocations(event_list, encoded_translations, empty_space, relocations):
+    # Spaces that touch are merged in the pool, so placements can run from one into the next.
+    spans = []
+    for start, end in sorted([(event_addr, event_addr + event_info['length'] - 1) for event_addr, event_info in event_list.items()] + [empty_space]):
+        if len(spans) > 0 and start <= spans[-1][1] + 1:
+            spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+        else:
+            spans.append((start, end))
+
+    placed = sorted((relocations[translation_addr], relocations[translation_addr] + len(translation_info['encoded']) - 1) for translation_addr, translation_info in encoded_translations.items())
+    for (start, end), (next_start, _) in zip(placed, placed[1:]):
+        assert end < next_start
+    for start, end in placed:
+        assert any(span_start <= start and end <= span_end for span_start, span_end in spans)
+
+
+def test_chosen_strategy_relocates_every_event():
+    rng = random.Random(32)
+
+    for _ in range(50):
+        event_list, encoded_translations = make_sector(rng, rng.randint(3, 25), 0.3)
+        empty_space = (0x8000, 0x8000 + rng.randint(0, 200))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                packing_strategy, placement = choose_packing_strategy(event_list, encoded_translations, empty_space)
+            except Exception:
+                continue
+            relocations = relocate_events(event_list, encoded_translations, placement=placement)
+
+        assert packing_strategy in PACKING_STRATEGIES + ['split']
+        check_relocations(event_list, encoded_translations, empty_space, relocations)
+
+
+def test_chosen_placement_matches_placing_again():
+    rng = random.Random(320)
+
+    for _ in range(50):
+        event_list, encoded_translations = make_sector(rng, rng.randint(3, 25), 0.2)
+        empty_space = (0x8000, 0x8000 + rng.randint(50, 200))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                packing_strategy, placement = choose_packing_strategy(event_list, encoded_translations, empty_space)
+            except Exception:
+                continue
+            if packing_strategy == 'split':
+                continue
+
+            assert relocate_events(event_list, encoded_translations, placement=placement) == relocate_events(event_list, encoded_translations, empty_space, packing_strategy)
+
+
+def test_preferred_strategy_is_kept_when_it_fits():
+    rng = random.Random(3200)
+    event_list, encoded_translations = make_sector(rng, 10, 0.1)
+    empty_space = (0x8000, 0x8400)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for preferred_strategy in PACKING_STRATEGIES:
+            packing_strategy, placement = choose_packing_strategy(event_list, encoded_translations, empty_space, preferred_strategy)
+            assert packing_strategy == preferred_strategy
+            assert placement[2] is not None
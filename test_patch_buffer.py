@@ -0,0 +1,170 @@
+import os
+import random
+from ds6_build_util import *
+
+
+def find_conflicts_naively(writes):
+    # Replays the writes a byte at a time, remembering which write set each byte last.
+    last_writes = {}
+    conflicts = []
+
+    for write_index, (address, data, origin, kind) in enumerate(writes):
+        for offset, value in enumerate(data):
+            last_write_index = last_writes.get(address + offset)
+            if last_write_index is not None:
+                last_address, last_data, last_origin, last_kind = writes[last_write_index]
+                if last_data[address + offset - last_address] != value and not is_expected_overlap(last_kind, kind):
+                    conflicts.append((address + offset, last_origin, origin))
+            last_writes[address + offset] = write_index
+
+    return sorted(conflicts)
+
+
+def apply_writes_naively(in_data, writes):
+    out_data = bytearray(in_data)
+    for address, data, _, _ in writes:
+        if address + len(data) > len(out_data):
+            out_data += bytes(address + len(data) - len(out_data))
+        out_data[address:address + len(data)] = data
+    return out_data
+
+
+def add_random_writes(rng, patch, base_addr, length):
+    writes = []
+    for write_index in range(rng.randint(1, 40)):
+        address = base_addr + rng.randint(0, length - 20)
+        if rng.random() < 0.2:
+            value, count = rng.randint(0, 3), rng.randint(1, 20)
+            patch.add_rle_record(address, bytes([value]), count, origin=f"write {write_index}")
+            writes.append((address, bytes([value]) * count))
+        else:
+            data = bytes(rng.randint(0, 3) for _ in range(rng.randint(1, 20)))
+            patch.add_record(address, data, origin=f"write {write_index}")
+            writes.append((address, data))
+    return writes
+
+
+def expand_conflicts(conflicts):
+    return sorted((address, first_origin, second_origin) for start, end, first_origin, second_origin in conflicts for address in range(start, end + 1))
+
+
+def test_overwriting_with_different_bytes_is_a_conflict():
+    patch = PatchBuffer()
+    patch.add_record(0x10, b'\x01\x02\x03\x04', origin="first")
+    patch.add_record(0x12, b'\x03\x05\x06', origin="second")
+
+    assert patch.find_conflicts() == [(0x13, 0x13, "first", "second")]
+
+
+def test_overwriting_with_the_same_bytes_is_not_a_conflict():
+    patch = PatchBuffer()
+    patch.add_record(0x10, b'\x01\x02\x03\x04', origin="first")
+    patch.add_record(0x11, b'\x02\x03', origin="second")
+
+    assert patch.find_conflicts() == []
+
+
+def test_reference_inside_code_is_not_a_conflict_in_either_order():
+    for first_kind, second_kind in [('code', 'reference'), ('reference', 'code')]:
+        patch = PatchBuffer()
+        patch.add_record(0x10, b'\x90' * 8, origin="first", kind=first_kind)
+        patch.add_record(0x12, b'\x34\x12', origin="second", kind=second_kind)
+
+        assert patch.find_conflicts() == []
+
+
+def test_other_kinds_conflict_in_either_order():
+    for first_kind, second_kind in [('code', 'data'), ('data', 'code'), ('reference', 'reference'), ('data', 'reference'), ('reference', 'data')]:
+        patch = PatchBuffer()
+        patch.add_record(0x10, b'\x90' * 8, origin="first", kind=first_kind)
+        patch.add_record(0x12, b'\x34\x12', origin="second", kind=second_kind)
+
+        assert patch.find_conflicts() == [(0x12, 0x13, "first", "second")]
+
+
+def test_only_the_bytes_that_were_last_written_are_compared():
+    patch = PatchBuffer()
+    patch.add_record(0x10, b'\x01' * 8, origin="first")
+    patch.add_record(0x10, b'\x02' * 8, origin="second")
+    patch.add_record(0x10, b'\x02' * 8, origin="third")
+
+    assert patch.find_conflicts() == [(0x10, 0x17, "first", "second")]
+
+
+def test_write_split_by_another_is_reported_once_per_stretch():
+    patch = PatchBuffer()
+    patch.add_record(0x10, b'\x01' * 8, origin="first")
+    patch.add_record(0x12, b'\x01\x01', origin="second")
+    patch.add_record(0x10, b'\x03' * 8, origin="third")
+
+    assert patch.find_conflicts() == [(0x10, 0x11, "first", "third"), (0x12, 0x13, "second", "third"), (0x14, 0x17, "first", "third")]
+
+
+def test_conflicts_match_naive_replay():
+    rng = random.Random(37)
+
+    for _ in range(200):
+        patch = PatchBuffer()
+        for write_index in range(rng.randint(1, 30)):
+            data = bytes(rng.choice([0, 1]) for _ in range(rng.randint(1, 12)))
+            patch.add_record(rng.randint(0, 40), data, origin=f"write {write_index}", kind=rng.choice(['code', 'reference', 'data']))
+
+        assert expand_conflicts(patch.find_conflicts()) == find_conflicts_naively(patch.writes)
+
+
+def test_merged_runs_apply_the_same_as_writing_in_order(tmp_path):
+    rng = random.Random(36)
+    in_data = bytes(rng.randint(0, 255) for _ in range(0x200))
+
+    for _ in range(100):
+        patch = PatchBuffer()
+        add_random_writes(rng, patch, 0, 0x220)
+        expected = apply_writes_naively(in_data, patch.writes)
+
+        assert patch.apply(in_data) == expected
+
+        # Runs that touch are always merged, so there's a gap between each one and the next.
+        runs = patch.runs
+        for (start, data), (next_start, _) in zip(runs, runs[1:]):
+            assert start + len(data) < next_start
+
+        records_patch = ips_util.Patch()
+        append_records(records_patch, patch.records)
+        assert records_patch.apply(in_data) == expected
+
+        file_name = os.path.join(tmp_path, "patch.ips")
+        with open(file_name, "wb") as out_file:
+            out_file.write(patch.encode())
+        assert ips_util.Patch.load(file_name).apply(in_data) == expected
+
+
+def test_adjacent_writes_become_one_record():
+    patch = PatchBuffer()
+    for address in range(0x100, 0x140, 2):
+        patch.add_record(address, bytes([address & 0xff, 0x12]))
+
+    assert len(patch.records) == 1
+
+
+def test_sector_mapped_writes_land_in_their_sectors():
+    rng = random.Random(360)
+    in_data = bytes(rng.randint(0, 255) for _ in range(0x1000))
+
+    for _ in range(50):
+        sector_addresses = rng.sample(range(0, 0x1000, 0x100), 4)
+        patch = SectorMappedPatchBuffer(sector_addresses, 0x4000, sector_length=0x100)
+        writes = add_random_writes(rng, patch, 0x4000, 0x400)
+
+        # Write each logical byte to wherever its sector is on the disk.
+        expected = bytearray(in_data)
+        for address, data in writes:
+            for offset, value in enumerate(data):
+                sector_index, sector_offset = divmod(address + offset - 0x4000, 0x100)
+                expected[sector_addresses[sector_index] + sector_offset] = value
+
+        assert patch.apply(in_data) == expected
+        assert apply_writes_naively(in_data, patch.writes) == expected
+
+        records_patch = ips_util.Patch()
+        append_records(records_patch, patch.records)
+        assert records_patch.apply(in_data) == expected
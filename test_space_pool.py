@@ -0,0 +1,113 @@
+import contextlib
+import io
+import random
+import pytest
+from build_patch import *
+
+
+class NaiveSpacePool:
+    # Keeps every free address in a set, and looks at all of them for each request.
+    def __init__(self):
+        self.free = set()
+
+    @property
+    def spans(self):
+        spans = []
+        for addr in sorted(self.free):
+            if len(spans) > 0 and spans[-1][1] == addr - 1:
+                spans[-1] = (spans[-1][0], addr)
+            else:
+                spans.append((addr, addr))
+        return spans
+
+    def add_space(self, start, end):
+        self.free.update(range(start, end + 1))
+
+    def take_space(self, length, strategy):
+        fitting = [(start, end) for start, end in self.spans if end - start + 1 >= length]
+        if len(fitting) == 0:
+            return None
+        if strategy == 'smallest':
+            start = min(fitting, key=lambda span: (span[1] - span[0], span[0]))[0]
+        elif strategy == 'largest':
+            start = min(fitting, key=lambda span: (span[0] - span[1], span[0]))[0]
+        else:
+            start = fitting[0][0]
+        return self.take_space_at(start, length)
+
+    def take_space_at(self, addr, length):
+        taken = set(range(addr, addr + length))
+        if not taken <= self.free:
+            return None
+        self.free -= taken
+        return addr
+
+
+def check_pools_match(space_pool, naive_pool):
+    spans = naive_pool.spans
+    assert space_pool.spans == spans
+    assert space_pool.total_available_space == len(naive_pool.free)
+    assert space_pool.largest_available_space == max([end - start + 1 for start, end in spans], default=0)
+
+
+def test_space_pool_matches_naive_pool():
+    rng = random.Random(30)
+
+    for _ in range(50):
+        space_pool = SpacePool()
+        naive_pool = NaiveSpacePool()
+
+        for _ in range(100):
+            operation = rng.choice(['add', 'take', 'take', 'take_at'])
+            if operation == 'add':
+                # Spans that overlap or touch existing ones are added too, to check that they're merged.
+                start = rng.randint(0, 600)
+                end = start + rng.randint(0, 40)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    space_pool.add_space(start, end)
+                naive_pool.add_space(start, end)
+            elif operation == 'take':
+                length = rng.randint(1, 30)
+                strategy = rng.choice(['first', 'smallest', 'largest'])
+                expected = naive_pool.take_space(length, strategy)
+                if expected is None:
+                    with pytest.raises(Exception):
+                        space_pool.take_space(length, strategy)
+                else:
+                    assert space_pool.take_space(length, strategy) == expected
+            else:
+                addr = rng.randint(0, 640)
+                length = rng.randint(1, 10)
+                expected = naive_pool.take_space_at(addr, length)
+                if expected is None:
+                    with pytest.raises(Exception):
+                        space_pool.take_space_at(addr, length)
+                else:
+                    assert space_pool.take_space_at(addr, length) == expected
+
+            check_pools_match(space_pool, naive_pool)
+
+
+def test_first_fit_skips_spans_that_are_too_small():
+    space_pool = SpacePool()
+    space_pool.add_space(0x10, 0x13)
+    space_pool.add_space(0x80000000, 0x8000000f)
+    space_pool.add_space(0x20, 0x2f)
+
+    assert space_pool.take_space(8) == 0x20
+    assert space_pool.take_space(8) == 0x28
+    assert space_pool.take_space(8) == 0x80000000
+    assert space_pool.spans == [(0x10, 0x13), (0x80000008, 0x8000000f)]
+
+
+def test_take_space_at_splits_a_span():
+    space_pool = SpacePool()
+    space_pool.add_space(0x100, 0x1ff)
+
+    assert space_pool.take_space_at(0x140, 0x10) == 0x140
+    assert space_pool.spans == [(0x100, 0x13f), (0x150, 0x1ff)]
+    assert space_pool.take_space(0x40) == 0x100
+    assert space_pool.largest_available_space == 0xb0
+
+    with pytest.raises(Exception):
+        space_pool.take_space_at(0x14f, 2)
@@ -0,0 +1,89 @@
+import random
+import pytest
+from build_patch import *
+
+
+def make_translations(rng, event_count):
+    event_list = {}
+    encoded_translations = {}
+
+    addr = 0x1000
+    for _ in range(event_count):
+        length = rng.randint(4, 80)
+        event_list[addr] = { 'is_relocatable': True, 'length': length, 'references': [] }
+        text = bytes(rng.choice(b'abcdefgh') for _ in range(length - 1))
+        encoded_translations[addr] = { 'encoded': bytearray(text + b'\x00'), 'orig_event_addr': addr, 'locators': {}, 'references': [] }
+        addr += length
+
+    return event_list, encoded_translations
+
+
+def make_space_pool(rng, span_count):
+    space_pool = SpacePool()
+    addr = 0x8000
+    for _ in range(span_count):
+        length = rng.randint(8, 60)
+        space_pool.add_space(addr, addr + length - 1)
+        addr += length + rng.randint(1, 10)
+    return space_pool
+
+
+def join_pieces(split_translations, translation_addr):
+    # Follows the jumps that were added at the end of each piece to put the translation back together.
+    joined = bytearray()
+    while True:
+        piece = split_translations[translation_addr]
+        jumps = [target_addr for offset, target_addr in piece['references'] if offset == len(piece['encoded']) - 2 and piece['encoded'][-3] == 0x0f]
+        if len(jumps) == 0:
+            return joined + piece['encoded']
+        joined += piece['encoded'][:-3]
+        translation_addr = jumps[0]
+
+
+def test_split_pieces_fit_and_join_back_up():
+    rng = random.Random(33)
+
+    for _ in range(100):
+        event_list, encoded_translations = make_translations(rng, rng.randint(1, 12))
+        space_pool = make_space_pool(rng, rng.randint(2, 20))
+        spans = space_pool.spans
+        relocatable_sizes = { addr: len(translation_info['encoded']) for addr, translation_info in encoded_translations.items() }
+
+        try:
+            placements, _, split_translations = split_events(event_list, encoded_translations, relocatable_sizes, space_pool)
+        except Exception:
+            continue
+
+        placed = sorted((placements[addr], placements[addr] + len(split_translations[addr]['encoded']) - 1) for addr in placements)
+        assert set(placements) == set(split_translations)
+        for (start, end), (next_start, _) in zip(placed, placed[1:]):
+            assert end < next_start
+        for start, end in placed:
+            assert any(span_start <= start and end <= span_end for span_start, span_end in spans)
+
+        for addr, translation_info in encoded_translations.items():
+            assert join_pieces(split_translations, addr) == translation_info['encoded']
+
+
+def test_translations_that_fit_are_not_split():
+    rng = random.Random(330)
+    event_list, encoded_translations = make_translations(rng, 5)
+    space_pool = SpacePool()
+    space_pool.add_space(0x8000, 0x8fff)
+    relocatable_sizes = { addr: len(translation_info['encoded']) for addr, translation_info in encoded_translations.items() }
+
+    placements, packing_method, split_translations = split_events(event_list, encoded_translations, relocatable_sizes, space_pool)
+
+    assert packing_method == "split (0 splits, 0 bytes of jumps)"
+    assert split_translations == encoded_translations
+    assert set(placements) == set(encoded_translations)
+
+
+def test_no_room_for_any_piece_is_an_error():
+    event_list = { 0x1000: { 'is_relocatable': True, 'length': 20, 'references': [] } }
+    encoded_translations = { 0x1000: { 'encoded': bytearray(b'a' * 19 + b'\x00'), 'orig_event_addr': 0x1000, 'locators': {}, 'references': [] } }
+    space_pool = SpacePool()
+    space_pool.add_space(0x8000, 0x8002)
+
+    with pytest.raises(Exception, match="even after splitting"):
+        split_events(event_list, encoded_translations, { 0x1000: 20 }, space_pool)
@@ -0,0 +1,94 @@
+import random
+from build_patch import *
+
+PHRASES = [b"The ", b"sword ", b"of ", b"light ", b"is ", b"sealed ", b"in ", b"the ", b"tower", b"!", b"\x82\xa0", b"\x01"]
+
+
+def make_sector(rng, event_count):
+    event_list = {}
+    encoded_translations = {}
+
+    addr = 0x1000
+    for _ in range(event_count):
+        encoded = bytearray(b"".join(rng.choice(PHRASES) for _ in range(rng.randint(1, 12))) + b"\x00")
+        event_list[addr] = { 'is_relocatable': True, 'length': len(encoded), 'references': [] }
+
+        # Some events have others that start part way through them.
+        locators = {}
+        for offset, code in get_encoded_instructions(encoded)[1:]:
+            if rng.random() < 0.05:
+                locators[addr + offset] = offset
+
+        encoded_translations[addr] = { 'encoded': encoded, 'orig_event_addr': addr, 'locators': locators, 'references': [] }
+        addr += len(encoded) + 0x10
+
+    return event_list, encoded_translations
+
+
+def get_entry_points(encoded_translations):
+    entry_points = {}
+    for translation_addr, translation_info in encoded_translations.items():
+        entry_points[translation_addr] = (translation_addr, 0)
+        for locator_addr, locator_offset in translation_info['locators'].items():
+            entry_points[locator_addr] = (translation_addr, locator_offset)
+    return entry_points
+
+
+def run_event(encoded_translations, entry_addr):
+    # Follows the jumps and calls that compression added, and returns everything else that gets run
+    # up to the end of the event.
+    entry_points = get_entry_points(encoded_translations)
+    translation_addr, offset = entry_points[entry_addr]
+    return_stack = []
+    output = bytearray()
+
+    while True:
+        encoded = encoded_translations[translation_addr]['encoded']
+        value = encoded[offset]
+
+        if value == 0x0f or value == 0x10:
+            if value == 0x10:
+                return_stack.append((translation_addr, offset + 3))
+            translation_addr, offset = entry_points[int.from_bytes(encoded[offset + 1:offset + 3], 'little')]
+        elif value == 0x06 and len(return_stack) > 0:
+            translation_addr, offset = return_stack.pop()
+        elif value == 0x00:
+            return output + b"\x00"
+        else:
+            length = EVENT_CODE_INFO[value]['length'] if value < 0x20 else (2 if value >= 0xe0 or (value >= 0x80 and value < 0xa0) else 1)
+            output += encoded[offset:offset + length]
+            offset += length
+
+
+def test_compressed_events_run_the_same_as_uncompressed():
+    rng = random.Random(34)
+
+    for _ in range(30):
+        event_list, encoded_translations = make_sector(rng, rng.randint(2, 40))
+        original_events = { entry_addr: run_event(encoded_translations, entry_addr) for entry_addr in get_entry_points(encoded_translations) }
+        original_size = sum(len(translation_info['encoded']) for translation_info in encoded_translations.values())
+
+        compress_translations(event_list, encoded_translations)
+
+        compressed_size = sum(len(translation_info['encoded']) for translation_info in encoded_translations.values())
+        assert compressed_size <= original_size
+        for entry_addr, original_event in original_events.items():
+            assert run_event(encoded_translations, entry_addr) == original_event
+
+
+def test_repeated_text_is_moved_into_a_subroutine():
+    event_list = {}
+    encoded_translations = {}
+    for event_index in range(4):
+        addr = 0x1000 + event_index * 0x100
+        encoded = bytearray(b"%d: the sword of light is sealed%d\x00" % (event_index, event_index))
+        event_list[addr] = { 'is_relocatable': True, 'length': len(encoded), 'references': [] }
+        encoded_translations[addr] = { 'encoded': encoded, 'orig_event_addr': addr, 'locators': {}, 'references': [] }
+    original_events = { addr: run_event(encoded_translations, addr) for addr in encoded_translations }
+
+    compress_translations(event_list, encoded_translations)
+
+    subroutines = [translation_info['encoded'] for addr, translation_info in encoded_translations.items() if addr not in event_list]
+    assert subroutines == [bytearray(b": the sword of light is sealed\x06")]
+    for addr, original_event in original_events.items():
+        assert run_event(encoded_translations, addr) == original_event
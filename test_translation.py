@@ -44,7 +44,11 @@ if __name__ == '__main__':
         print(f"Translated {translation_count}/{len(event_list)} events ({100 * translation_count / len(event_list)}%)")
 
         encoded_translations = encode_translations(event_list, trans)
-        relocations = relocate_events(event_list, encoded_translations, space_at_end_length, packing_strategy)
+        placement = None
+        if packing_strategy is None:
+            packing_strategy, placement = choose_packing_strategy(event_list, encoded_translations, space_at_end_length)
+            print(f"Using packing strategy {packing_strategy}")
+        relocations = relocate_events(event_list, encoded_translations, space_at_end_length, packing_strategy, placement=placement)
         reference_changes = update_references(event_list, relocations, encoded_translations)
 
         for event_addr, event_info in event_list.items():
@@ -0,0 +1,58 @@
+import os
+import random
+from build_patch import *
+
+
+def make_disk(tmp_path, rng, length):
+    source_file_name = os.path.join(tmp_path, "source.nfd")
+    with open(source_file_name, "wb") as source_file:
+        source_file.write(bytes(rng.randint(0, 255) for _ in range(length)))
+    return source_file_name
+
+
+def read_file(file_name):
+    with open(file_name, "rb") as in_file:
+        return in_file.read()
+
+
+def test_output_matches_applying_the_patch(tmp_path):
+    rng = random.Random(38)
+    source_file_name = make_disk(tmp_path, rng, 0x1000)
+    output_file_name = os.path.join(tmp_path, "out", "patched.nfd")
+
+    for _ in range(20):
+        patch = PatchBuffer()
+        for _ in range(rng.randint(1, 20)):
+            # Some writes go past the end of the source, which should pad it out with zeros.
+            patch.add_record(rng.randint(0, 0x1040), bytes(rng.randint(0, 255) for _ in range(rng.randint(1, 0x40))))
+
+        write_patched_disk(patch, source_file_name, output_file_name)
+
+        assert read_file(output_file_name) == patch.apply(read_file(source_file_name))
+
+
+def test_unchanged_output_is_not_written_again(tmp_path, capsys):
+    rng = random.Random(380)
+    source_file_name = make_disk(tmp_path, rng, 0x400)
+    output_file_name = os.path.join(tmp_path, "out", "patched.nfd")
+    manifest = BuildManifest(os.path.join(tmp_path, "build", "manifest.json"), "test")
+
+    patch = PatchBuffer()
+    patch.add_record(0x10, b'\x01\x02\x03')
+
+    write_patched_disk(patch, source_file_name, output_file_name, manifest)
+    write_patched_disk(patch, source_file_name, output_file_name, manifest)
+    assert capsys.readouterr().out.count("(unchanged)") == 1
+
+    # Editing the output by hand means it has to be written again.
+    with open(output_file_name, "r+b") as out_file:
+        out_file.write(bytes([read_file(output_file_name)[0] ^ 0xff]))
+    write_patched_disk(patch, source_file_name, output_file_name, manifest)
+    assert "(unchanged)" not in capsys.readouterr().out
+    assert read_file(output_file_name) == patch.apply(read_file(source_file_name))
+
+    # So does changing the patch.
+    patch.add_record(0x20, b'\x04')
+    write_patched_disk(patch, source_file_name, output_file_name, manifest)
+    assert "(unchanged)" not in capsys.readouterr().out
+    assert read_file(output_file_name) == patch.apply(read_file(source_file_name))